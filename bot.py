@@ -2,16 +2,21 @@ from __future__ import  absolute_import, print_function
 
 import collections
 import hashlib
+import heapq
 import imp
+import itertools
 import os
-import Queue
 import re
+import signal
 import sys
 import threading
 import time
 import traceback
 
 import config
+import directory
+import event_queue
+import events
 import exception
 import module_thread
 import modules
@@ -19,16 +24,32 @@ import slack
 import util
 
 home = os.getcwd()
+SNAPSHOT_FILENAME = 'directory'
+SNAPSHOT_VERSION = 1
+# @user and #channel mentions in text the bot says
+_OUTGOING_MENTION = re.compile(r"(^| )([@#])(\w+)\b")
 
 
 class _SlackBotWrapper(object):
+    """
+    The bot as commands see it while handling an event: replies go to
+    the event's channel. One is shared by every command the event runs.
+    """
+    __slots__ = ('_bot', '_msg', '_channel')
+
     def __init__(self, bot, msg):
         object.__setattr__(self, '_bot', bot)
         object.__setattr__(self, '_msg', msg)
-        object.__setattr__(self, 'channel', bot.get_channel(msg.get(u'channel')))
+        object.__setattr__(self, '_channel', modules.UNSET)
+
+    @property
+    def channel(self):
+        if self._channel is modules.UNSET:
+            object.__setattr__(self, '_channel', self._bot.get_channel(self._msg.get(u'channel')))
+        return self._channel
 
-    def reply(self, message):
-        self.say(message, self._msg[u'channel'])
+    def reply(self, message, split=True):
+        self.say(message, self._msg[u'channel'], split=split)
 
     def __getattr__(self, other):
         """Default to _bot's methods"""
@@ -40,35 +61,156 @@ class _SlackBotWrapper(object):
 
 class SlackBot(object):
     def __init__(self):
-        self._message_id = int(time.time())
-        self._incoming_messages = Queue.Queue()
-        self.pending_outgoing_messages = {}
+        self._started = time.time()
+        self._message_ids = itertools.count(int(time.time()))
+        self._incoming_messages = event_queue.EventQueue(
+            maxsize=getattr(config, 'event_queue_size', 10000),
+            overflow=getattr(config, 'event_queue_overflow', 'drop'))
+        self._deduplicator = event_queue.Deduplicator(size=getattr(config, 'dedup_size', 5000))
+        self.pending_outgoing_messages = slack.AckTracker(
+            ttl=getattr(config, 'ack_timeout', 30), on_expire=self._unacknowledged)
         self.previous_messages = collections.deque()
 
         self.config = {
             'send_channel': config.default_channel,
             'terminal_ping': config.terminal_ping,
+            'dispatch_budget': getattr(config, 'dispatch_budget', 0.25),
+            'dispatch_hard_limit': getattr(config, 'dispatch_hard_limit', 5),
         }
+        self._running_command = None  # (command, start time) on the dispatcher
+
+        module_thread.pool = module_thread.WorkerPool(
+            max_workers=getattr(config, 'worker_threads', 8),
+            max_queue=getattr(config, 'worker_queue', 32),
+            overflow=getattr(config, 'worker_overflow', 'reject'),
+            ordered=getattr(config, 'worker_ordered', False),
+        )
 
-        self._slack_api = slack.SlackAPI(self)
-        self._slack_api.connect()
-        self._slack_api.start_listening(self._listener)
         self._debug_fn = None
+        self.user = None
+        self.user_name = None
 
-        self.commands = []
+        self._command_table = modules.CommandTable()
+        self._commands_lock = threading.Lock()
+        self._expirations = []  # heap of (deadline, command) pairs
+        self._expiry_condition = threading.Condition(self._commands_lock)
+
+        self._slack_api = slack.SlackAPI(self)
+        self._outbox = slack.Outbox(
+            self._send_message,
+            rate=getattr(config, 'send_rate', 1.),
+            burst=getattr(config, 'send_burst', 3),
+            window=getattr(config, 'send_window', 0.1),
+            on_error=self._unsent,
+        )
+        self.directory = directory.Directory(fetch=self._slack_api.send_web)
+        # Start from the last known state of the team if there is one,
+        # so events can be handled before the handshake with Slack is done.
+        warm_start = self._load_snapshot()
+        if not warm_start:
+            self._connect()
+        self._modules_loaded = False
+        self._slack_api.start_listening(self._listener, wants=self._wants)
         self.load_all_modules()
+        self._modules_loaded = True
+
+        self._dispatcher_thread = None
+        for target in (self._dispatcher, self._expirer, self._watchdog):
+            t = threading.Thread(target=target)
+            t.setDaemon(True)
+            t.start()
+            if target == self._dispatcher:
+                self._dispatcher_thread = t
+
+        if warm_start:
+            t = threading.Thread(target=self._connect_in_background)
+            t.setDaemon(True)
+            t.start()
+
+    @property
+    def commands(self):
+        """All registered commands, in priority order."""
+        return self._command_table.commands
+
+    def _connect(self):
+        self._slack_api.connect()
+        self._save_snapshot()
 
-        t = threading.Thread(target=self._dispatcher)
-        t.setDaemon(True)
-        t.start()
+    def _connect_in_background(self):
+        try:
+            self._connect()
+        except Exception:
+            self.debug(traceback.format_exc(), 'red')
+            self._slack_api.reconnect()
+
+    def disconnected(self):
+        """Called by the Slack API when it's lost the connection."""
+        # Acks for messages sent over the old connection won't come.
+        self.pending_outgoing_messages.expire(everything=True)
+
+    def reconnected(self, downtime):
+        """Called by the Slack API once it's replaced a lost connection."""
+        self.debug("Reconnected after {:.1f}s.".format(downtime), 'yellow')
+        self._save_snapshot()
+
+    def set_identity(self, user, user_name):
+        """
+        Set the user id and name the bot goes by on Slack. Rules that
+        refer to the bot are recompiled if they've changed.
+        """
+        with self._commands_lock:
+            if (user, user_name) != (self.user, self.user_name):
+                self.user = user
+                self.user_name = user_name
+                for command in self._command_table:
+                    command.compile(user, user_name)
+
+    def _load_snapshot(self):
+        """
+        Load the directory and the bot's identity as they were last
+        saved. Returns whether there was a snapshot to load.
+        """
+        try:
+            version, data = modules.get_readable(SNAPSHOT_FILENAME)
+        except ValueError:  # corrupt
+            return False
+        if version != SNAPSHOT_VERSION or not data:
+            return False
+        self.directory.restore(data)
+        self.set_identity(data['self']['id'], data['self']['name'])
+        return True
+
+    def _save_snapshot(self):
+        """
+        Save the directory and the bot's identity so the next startup
+        doesn't have to wait on Slack to get going.
+        """
+        data = self.directory.snapshot()
+        data['self'] = {'id': self.user, 'name': self.user_name}
+        try:
+            modules.save_readable(data, SNAPSHOT_FILENAME, version=SNAPSHOT_VERSION)
+        except IOError:
+            self.debug("Couldn't save directory snapshot:\n" + traceback.format_exc(), 'yellow')
 
     def _listener(self, message):
         """
         The listener simply enqueues the message to ensure we're
-        able to listen for any further messages immediately.
+        able to listen for any further messages immediately. Messages
+        already received once are ignored.
         """
+        if self._deduplicator.seen(message):
+            return
         self._incoming_messages.put(message)
 
+    def _wants(self, event_type):
+        """
+        Determine if any command currently registered could act on
+        events of the given type, so the rest can be ignored.
+        """
+        if not self._modules_loaded:  # Keep everything until they are.
+            return True
+        return self._command_table.wants(event_type, self.config)
+
     def parse_destination(self, destination):
         if destination[0] == "#":
             return self.get_channel_id(destination[1:])
@@ -76,107 +218,150 @@ class SlackBot(object):
             return self.get_user_im(destination[1:])
         return destination
 
-    def say(self, text, channel):
+    def say(self, text, channel, split=True):
+        """
+        Send text to a channel. Text too long for one message is sent as
+        several, in order, unless split is False, in which case it raises
+        MessageTooLongException instead.
+        """
         if not text:
             return
         if not isinstance(text, unicode):
             text = unicode(str(text), 'utf8')
         channel = self.parse_destination(channel)
-        if len(text) > util.MAX_MESSAGE_LENGTH:
+        if len(text) > util.MAX_MESSAGE_LENGTH and not split:
             raise exception.MessageTooLongException
+        for chunk in util.split_message(text):
+            self._outbox.put(channel, chunk, self._format_outgoing(chunk))
+
+    def _send_message(self, channel, text, formatted_text, attempt=0):
+        """
+        Send a message over the websocket, now, or as soon as it's back
+        up if it's down. Messages normally go through `say`, which paces
+        and coalesces them.
+        """
+        # Don't start the ack clock on a message until it can go out.
+        if not self._slack_api.wait_connected():
+            raise slack.SlackError("Connection closed.")
+        message_id = next(self._message_ids)
         message = dict(
-            id=self._message_id,
+            id=message_id,
             type='message',
             channel=channel,
-            text=self._format_outgoing(text),
+            text=formatted_text,
         )
-        self.pending_outgoing_messages[self._message_id] = {u'text': text, u'channel': channel}
-        self._message_id += 1
+        self.pending_outgoing_messages.add(
+            message_id, {u'text': text, u'channel': channel}, attempt=attempt)
         self._slack_api.send(message)
 
+    def _unsent(self, channel, text):
+        """Report a message the outbox failed to send, from its exception handler."""
+        self.debug(u"Couldn't send message to {}: {}\n{}".format(
+            self.get_channel_name(channel) or channel, text[:50],
+            traceback.format_exc().decode('utf-8', 'replace')), 'red')
+
+    def _unacknowledged(self, message_id, entry, attempt):
+        """
+        Report a message Slack never acknowledged, and send it again if
+        the config allows another attempt.
+        """
+        channel = entry[u'channel']
+        retry = attempt < getattr(config, 'ack_resends', 0) and channel is not None
+        try:
+            self.debug(u"Message {} to {} was never acknowledged{}: {}".format(
+                message_id, self.get_channel_name(channel) or channel,
+                ", sending again" if retry else "", entry[u'text'][:50]), 'yellow')
+            if retry:
+                self._outbox.put(
+                    channel, entry[u'text'], self._format_outgoing(entry[u'text']), attempt + 1)
+        except Exception:
+            self.debug(traceback.format_exc(), 'red')
+
     def edit_message(self, timestamp, channel, new_text):
         """
         Given the timestamp and channel of a previously sent message,
         replace the text with the specified new_text.
+
+        The edit is made in the background; returns a `slack.WebCall`
+        whose `result()` may be waited on. Edits to the same message
+        that haven't been made yet are merged, so only the latest text
+        is sent.
         """
         # TODO: This signature is pretty rough from a usability
         # standpoint. Maybe abstract away the millisecond timestamp
         # in favor of message matching? Possibly utilize Slack's PING
         # functionality??
-        self._slack_api.send_web('chat.update', dict(
+        return self._slack_api.send_web_async('chat.update', dict(
             ts=timestamp,
             channel=channel,
             text=new_text,
-        ))
+        ), key=('chat.update', channel, timestamp))
 
     def open_dm(self, user):
         """
         Request a direct message channel a user by @username or user id.
+
+        Returns a `slack.WebCall` whose `result()` may be waited on.
         """
         user = self._parse_user_id(user)
-        return self._slack_api.send_web('im.open', dict(user=user))
+        return self._slack_api.send_web_async('im.open', dict(user=user))
 
     def close_dm(self, user):
         """
         Request a direct message channel between a user and this bot be
         closed. NB: Slack seems to ignore this outright.
+
+        Returns a `slack.WebCall` whose `result()` may be waited on, or
+        None if there was no direct message channel.
         """
         user = self._parse_user_id(user)
-        dm = self.users[user][u'im']
+        dm = self.directory.get_user(user).im
         if dm:
-            return self._slack_api.send_web('im.close', dict(channel=dm))
+            return self._slack_api.send_web_async('im.close', dict(channel=dm))
 
     def _format_outgoing(self, msg):
-        msg = re.sub(r"(^| )@(\w+)\b", self._format_user_mention, msg)
-        msg = re.sub(r"(^| )#(\w+)\b", self._format_channel_mention, msg)
-        return msg
-
-    def _format_user_mention(self, match):
-        start, nick = match.groups()
-        user_id = self.get_user_id(nick)
-        if user_id:
-            return "{}<@{}>".format(start, user_id)
-        elif nick in ('channel', 'everyone', 'group'):
-            return "{}<!{}>".format(start, nick)
-        return match.group(0)
+        return _OUTGOING_MENTION.sub(self._format_mention, msg)
 
-    def _format_channel_mention(self, match):
-        start, channel = match.groups()
-        channel_id = self.get_channel_id(channel)
-        if channel_id:
-            return "{}<#{}>".format(start, channel_id)
+    def _format_mention(self, match):
+        start, sigil, name = match.groups()
+        if sigil == '@':
+            user_id = self.get_user_id(name)
+            if user_id:
+                return u"{}<@{}>".format(start, user_id)
+            elif name in ('channel', 'everyone', 'group'):
+                return u"{}<!{}>".format(start, name)
+        else:
+            channel_id = self.get_channel_id(name)
+            if channel_id:
+                return u"{}<#{}>".format(start, channel_id)
         return match.group(0)
 
-    def _format_incoming(self, incoming):
-        try:
-            incoming[u'channel_name'] = self.get_channel_name(incoming[u'channel'])
-        except:
-            pass
-        if u'user' in incoming:
-            username = self.get_nick(incoming[u'user'])
-            if username:
-                incoming[u'user_name'] = username
-        if u'<http' in incoming.get(u'text', ''):
-            text = incoming[u'text']
-            incoming[u'text'] = re.sub(r'<(http[^>]+)>', r'\1', text)
-
     def _dispatcher(self):
         """
         Receive messages and route them to functionality.
         """
+        first = True
         while 1:
             try:
-                response = self._incoming_messages.get(block=True)
-                self._format_incoming(response)
-                now = time.time()
+                response = events.Event(self, self._incoming_messages.get())
+                if first:
+                    first = False
+                    self.debug("First event dispatched {:.2f}s after startup.".format(
+                        time.time() - self._started), 'gray')
                 # match the event to the best command
-                for command in self.commands[:]:
-                    if command.deadline is not False and command.deadline < now:
-                        self.unregister_command(command)  # silently remove him
+                after_mention = self._after_mention(response.get(u'text'))
+                actionable = self._command_table.get(
+                    response.get('type'), mentioned=after_mention is not None)
+                view = None  # the bot as the event's commands see it
+                for command in actionable:
+                    if (command.mention_prefix and after_mention is not None and
+                            not after_mention.startswith(command.mention_prefix)):
                         continue
                     match = command.matches(self, response)
                     if match:
-                        command(_SlackBotWrapper(self, response), response, *match.groups())
+                        if view is None:
+                            view = _SlackBotWrapper(self, response)
+                        self._run_command(command, view, response, match)
                         if command.activations is not False and command.activations <= 0:
                             self.unregister_command(command)
             except Exception:
@@ -187,6 +372,67 @@ class SlackBot(object):
                         self.debug(response, 'gray')
                 except:
                     print("Wow something went REAL wrong.")
+            finally:
+                self._incoming_messages.task_done()
+
+    def _run_command(self, command, view, response, match):
+        """
+        Run a matched command, timing it if it runs on this thread.
+
+        Commands that consistently blow the dispatch budget are moved
+        onto the worker pool so they stop holding up other events.
+        """
+        inline = not (command.threaded or command.offloaded)
+        started = time.time()
+        self._running_command = (command, started)
+        try:
+            command(view, response, *match.groups())
+        finally:
+            self._running_command = None
+            if inline and command.record_runtime(
+                    time.time() - started, self.config['dispatch_budget']):
+                self.debug("{} is averaging {:.2f}s, moving it off the dispatcher thread.".format(
+                    command, command.runtime), 'yellow')
+
+    def _watchdog(self):
+        """
+        Report any command that holds the dispatcher thread past the
+        hard limit, along with what it's doing. Also expire outgoing
+        messages that have gone unacknowledged too long.
+        """
+        reported = None
+        while 1:
+            hard_limit = self.config['dispatch_hard_limit']
+            time.sleep(min(1, hard_limit / 2.))
+            try:
+                self.pending_outgoing_messages.expire()
+                running = self._running_command
+                if running is None or running is reported:
+                    continue
+                command, started = running
+                if time.time() - started > hard_limit:
+                    reported = running
+                    frame = sys._current_frames().get(self._dispatcher_thread.ident)
+                    self.debug(u'{}\n{} has held the dispatcher for over {}s.'.format(
+                        ''.join(traceback.format_stack(frame)) if frame else '',
+                        command, hard_limit), 'red')
+            except Exception:
+                self.debug(traceback.format_exc(), 'red')
+
+    def _after_mention(self, text):
+        """
+        If `text` opens by pinging the bot, return the text following
+        the ping (as `$@bot` rules see it). Otherwise return None.
+        """
+        if not isinstance(text, basestring):
+            return None
+        mention = u'<@{}>'.format(self.user)
+        if not text.startswith(mention):
+            return None
+        text = text[len(mention):]
+        if text[:1] == u':':
+            text = text[1:]
+        return text.lstrip(u' \t\n\r\f\v')
 
     def set_debug_fn(self, fn):
         self._debug_fn = fn
@@ -197,51 +443,101 @@ class SlackBot(object):
         else:
             print(string)
 
+    def shutdown(self, timeout=10):
+        """
+        Wind the bot down: stop taking in events, let the dispatcher
+        finish the events already received, stop threaded commands, and
+        close the connection to Slack.
+
+        Gives up on waiting for events and threads once `timeout`
+        seconds have passed.
+        """
+        deadline = time.time() + timeout
+        self._slack_api.stop_listening(self._listener)
+
+        unhandled = self._incoming_messages.join(timeout=max(0, deadline - time.time()))
+        if unhandled:
+            self.debug("Dropped {} unhandled events.".format(unhandled), 'yellow')
+
+        stragglers = module_thread.join_threads(timeout=max(0, deadline - time.time()))
+        if stragglers:
+            self.debug("Gave up waiting on {}.".format(', '.join(map(str, stragglers))), 'yellow')
+        if not self._slack_api.scheduler.join(timeout=max(0, deadline - time.time())):
+            self.debug("Dropped unsent Web API calls.", 'yellow')
+        if not self._outbox.join(timeout=max(0, deadline - time.time())):
+            self.debug("Dropped unsent messages.", 'yellow')
+        self._slack_api.close()
+        self._save_snapshot()
+
     def die(self):
         sys.exit(0)
 
+    def stats(self):
+        """Get lines describing the bot's runtime metrics."""
+        return (
+            self._incoming_messages.stats() + self._deduplicator.stats() +
+            self._slack_api.stats() + self._outbox.stats() +
+            self.pending_outgoing_messages.stats(lambda c: self.get_channel_name(c) or c))
+
     # ===
+    @property
+    def users(self):
+        """All the users of the team, by user id."""
+        return self.directory.users
+
     def get_nick(self, user_id):
-        try:
-            return self.users[user_id][u'name']
-        except TypeError:
+        user = self.directory.get_user(user_id)
+        if user is None:
             return None
+        return user.name
 
     def get_user_id(self, name):
-        return next((u[u'id'] for u in self.users.itervalues() if u[u'name'] == name), None)
+        user = self.directory.get_user_by_name(name)
+        if user is None:
+            return None
+        return user.id
 
     def get_user_im(self, name):
-        return next((u[u'im'] for u in self.users.itervalues() if u[u'name'] == name), None)
-
-    def _get_channel(self, conditional, prop=None):
-        return next((c[prop] if prop else c for c in self._channels if conditional(c)), None)
+        user = self.directory.get_user_by_name(name)
+        if user is None:
+            return None
+        return user.im
 
     def get_channel(self, channel_id):
-        return self._get_channel(lambda c: c[u'id'] == channel_id)
+        return self.directory.get_channel(channel_id)
 
     def get_channel_id(self, name):
-        return self._get_channel(lambda c: c[u'name'] == name, u'id')
+        channel = self.directory.get_channel_by_name(name)
+        if channel is None:
+            return None
+        return channel.id
 
     def get_channel_name(self, channel_id):
+        if not isinstance(channel_id, basestring):  # e.g. a destination that didn't resolve
+            return None
         channel_name = None
         if channel_id.startswith('C'):
             formatter = "#{}".format
-            channel_name = self._get_channel(lambda c: c[u'id'] == channel_id, u'name')
+            channel = self.directory.get_channel(channel_id)
+            if channel is not None:
+                channel_name = channel.name
         elif channel_id.startswith('D'):
             formatter = "@{}".format
-            channel_name = next((
-                user[u'name']
-                for user in self.users.itervalues()
-                if user[u'im'] == channel_id), None)
+            user = self.directory.get_user_by_im(channel_id)
+            if user is not None:
+                channel_name = user.name
         if channel_name:
             channel_name = formatter(channel_name)
         return channel_name
 
     def get_channel_members(self, channel_id):
-        return self._get_channel(lambda c: c[u'id'] == channel_id, u'members')
+        channel = self.directory.get_channel(channel_id)
+        if channel is None:
+            return None
+        return channel.members
 
     def get_channel_names(self):
-        return [channel[u'name'] for channel in self._channels]
+        return self.directory.channel_names()
 
     def _parse_user_id(self, user):
         at_hint = " Perhaps you omitted the '@'?"
@@ -281,7 +577,7 @@ class SlackBot(object):
         """
         if filename is None:
             filename = self.get_module_path(name)
-        cmds = self.commands[:]  # backup the commands (in case of failure)
+        table = self._command_table  # backup the commands (in case of failure)
         module_cmds = None
         module_id = self.get_module_id(name)
         if module_id in modules.register.modules:
@@ -291,6 +587,9 @@ class SlackBot(object):
         try:
             # commands are registered automatically
             module = imp.load_source(module_id, filename)
+            commands = modules.register.module(module_id)
+            if commands is not None:
+                self.register_commands(commands)
             # # If you decide to use a setup method uncomment this,
             # # although actually it would probably be better as an
             # # explicit decorator. Ones for 'onload', 'onunload',
@@ -302,34 +601,76 @@ class SlackBot(object):
                 "{}\nError loading {}: {} (in bot.py)".format(traceback.format_exc(), module_id, e),
                 'red'
             )
-            self.commands = cmds  # replace commands' previous state
+            with self._commands_lock:
+                self._command_table = table  # replace commands' previous state
             if module_cmds is not None:
                 modules.register.load_module(module_id, module_cmds)  # reload module's previous state
             elif module_id in modules.register.modules:  # loaded a couple commands
                 modules.register.unload_module(module_id)
             return e
-        else:
-            commands = modules.register.module(module_id)
-            if commands is not None:
-                self.register_commands(commands)
         return None
 
     def register_commands(self, commands):
-        self.commands.extend(commands)
-        self.commands.sort(key=lambda cmd: -cmd.priority)
+        """
+        Start dispatching events to the given commands, compiling their
+        rules first. Raises an exception if any rule is invalid, without
+        registering any of them.
+        """
+        with self._commands_lock:
+            for command in commands:
+                command.compile(self.user, self.user_name)
+            self._command_table = self._command_table.with_commands(commands)
+            for command in commands:
+                if command.deadline is not False:
+                    heapq.heappush(self._expirations, (command.deadline, command))
+            self._expiry_condition.notify()
 
     def unregister_command(self, command):
-        # TODO: Since commands are priority-ordered you could binary search
-        self.commands.remove(command)
+        with self._commands_lock:
+            self._command_table = self._command_table.without_commands([command])
         modules.register.unregister_command(command)
 
     def unload_module(self, module_id):
         unregistered_commands = modules.register.unload_module(module_id)
-        for command in unregistered_commands:
-            # TODO: Also binary search here?
-            self.commands.remove(command)
+        with self._commands_lock:
+            self._command_table = self._command_table.without_commands(unregistered_commands)
         return unregistered_commands
 
+    def _expire_commands(self):
+        """
+        Silently unregister the commands whose ttl has run out.
+
+        Commands unregistered some other way are left in the heap, and
+        are simply discarded when their deadline comes up.
+        """
+        now = time.time()
+        expired = []
+        with self._commands_lock:
+            while self._expirations and self._expirations[0][0] < now:
+                _, command = heapq.heappop(self._expirations)
+                if command in self._command_table:
+                    expired.append(command)
+            if expired:
+                self._command_table = self._command_table.without_commands(expired)
+        for command in expired:
+            modules.register.unregister_command(command)
+
+    def _expirer(self):
+        """
+        Unregister commands as soon as their ttl runs out, rather than
+        waiting for the next event to notice.
+        """
+        while 1:
+            try:
+                self._expire_commands()
+            except Exception:
+                self.debug(traceback.format_exc(), 'red')
+            with self._expiry_condition:
+                if self._expirations:
+                    self._expiry_condition.wait(self._expirations[0][0] - time.time())
+                else:
+                    self._expiry_condition.wait()
+
     @staticmethod
     def get_module_id(name):
         return "{}_{}".format(name, hashlib.md5(name).hexdigest())
@@ -337,12 +678,18 @@ class SlackBot(object):
 
 if __name__ == "__main__":
     bot = SlackBot()
+    shutdown = threading.Event()
 
-    try:
-        while 1:
-            pass
-    except (EOFError, KeyboardInterrupt):
-        bot.debug("Press Enter to continue shutdown.")
-        module_thread.join_threads()
+    def request_shutdown(signum, frame):
+        shutdown.set()
+
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, request_shutdown)
+
+    # Sleep until a signal arrives, rather than spinning.
+    while not shutdown.is_set():
+        signal.pause()
+    bot.debug("Shutting down ...")
+    bot.shutdown()
     print("\nBe seeing you ...")
     bot.die()
@@ -0,0 +1,72 @@
+"""
+JSON encoding and decoding for everything the bot sends, receives, and
+saves. Uses ujson when it's installed, which decodes Slack's frames
+several times faster than the json module, and falls back to json when
+it's not.
+
+Run this module on a file of newline-delimited frames (as recorded with
+`record_frames` in the config) to compare the two:
+
+    python codec.py data/frames.jsonl
+"""
+import json
+import sys
+import time
+
+try:
+    import ujson
+except ImportError:  # Fall back to the json module.
+    ujson = None
+
+
+def _json_dumps(obj):
+    return json.dumps(obj)
+
+
+def _ujson_dumps(obj):
+    return ujson.dumps(obj, ensure_ascii=False, escape_forward_slashes=False)
+
+
+CODECS = {'json': (json.loads, _json_dumps)}
+if ujson is not None:
+    CODECS['ujson'] = (ujson.loads, _ujson_dumps)
+
+name = 'ujson' if ujson is not None else 'json'
+loads, dumps = CODECS[name]
+
+
+def load(f):
+    return loads(f.read())
+
+
+def dump(obj, f):
+    f.write(dumps(obj))
+
+
+def benchmark(frames, repeat=5):
+    """
+    Time decoding every frame with each available codec, returning
+    (name, frames per second) from fastest to slowest.
+    """
+    results = []
+    for codec_name, (decode, _) in CODECS.iteritems():
+        best = None
+        for _ in xrange(repeat):
+            started = time.time()
+            for frame in frames:
+                decode(frame)
+            elapsed = time.time() - started
+            best = elapsed if best is None else min(best, elapsed)
+        results.append((codec_name, len(frames) / max(best, 1e-9)))
+    return sorted(results, key=lambda result: -result[1])
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 2:
+        print "Usage: python codec.py FRAMES_FILE"
+        sys.exit(1)
+    with open(sys.argv[1]) as f:
+        frames = [line.decode('utf-8') for line in f if line.strip()]
+    print "{} frames, {} bytes".format(len(frames), sum(map(len, frames)))
+    for codec_name, rate in benchmark(frames):
+        print "{:>6}: {:,.0f} frames/s".format(codec_name, rate)
@@ -0,0 +1,298 @@
+"""
+Lookup tables for the users and channels of the Slack team.
+"""
+
+import collections
+import itertools
+import threading
+
+
+class _Record(object):
+    """
+    A slim, fixed set of fields, readable as attributes or dict-style.
+    """
+    __slots__ = ()
+
+    def __getitem__(self, key):
+        if key not in self.__slots__:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __repr__(self):
+        return '{}({})'.format(type(self).__name__, ', '.join(
+            '{}={!r}'.format(field, getattr(self, field)) for field in self.__slots__))
+
+
+class User(_Record):
+    """
+    The fields of a Slack user the bot reads. Anything else about the
+    user can be fetched with `Directory.user_details`.
+    """
+    __slots__ = ('id', 'name', 'im')
+
+    def __init__(self, id, name, im=None):
+        self.id = id
+        self.name = name
+        self.im = im
+
+
+class Channel(_Record):
+    """
+    The fields of a Slack channel the bot reads. `members` is a tuple
+    of user ids shared with the directory's users. Anything else about
+    the channel can be fetched with `Directory.channel_details`.
+    """
+    __slots__ = ('id', 'name', 'members')
+
+    def __init__(self, id, name, members=()):
+        self.id = id
+        self.name = name
+        self.members = members
+
+
+class Directory(object):
+    """
+    The team's users and channels, indexed by id, by name, and (for
+    users) by direct message channel, so lookups don't need to scan
+    the whole team.
+
+    The directory is filled wholesale on connect, then kept up to date
+    incrementally as RTM events come in. Only the fields the bot reads
+    are kept, in slotted records: on 64-bit CPython 2.7 a user costs
+    about 700 bytes all told (strings and indexes included), against
+    roughly 6KB for a typical user object from `rtm.start`. Channel
+    members share the users' id strings, so membership costs 8 bytes
+    per member. `fetch`, if given, is
+    called as `fetch(method, payload)` against the Slack Web API to
+    look up the rest of a user or channel on demand.
+    """
+    def __init__(self, fetch=None):
+        self._fetch = fetch
+        self._loading_ids = None  # ids seen so far, while loading
+        self.users = {}  # user id: user
+        self.channels = {}  # channel id: channel
+        self._user_ids = {}  # user name: user id
+        self._im_users = {}  # direct message channel id: user id
+        self._channel_ids = {}  # channel name: channel id
+        self._lock = threading.RLock()
+
+    def load(self, entries):
+        """
+        Bring the directory up to date with the team's full list of
+        users, channels, and direct message channels.
+
+        `entries` is an iterable of ('user' | 'channel' | 'im', Slack
+        object) pairs, in any order, so the directory can be built as a
+        response streams in. Direct message channels are joined to
+        their users once all the entries have been read.
+
+        The directory is updated in place rather than rebuilt, so it
+        stays usable throughout. Returns a Counter of how many records
+        were 'added', 'changed', and 'removed'.
+        """
+        changes = collections.Counter()
+        with self._lock:
+            self._loading_ids = {}
+            user_ids = set()
+            added_user_ids = set()
+            channel_ids = set()
+            ims = {}
+            try:
+                for kind, entry in entries:
+                    if kind == 'user':
+                        change = self.add_user(entry)
+                        changes[change] += 1
+                        user_ids.add(entry[u'id'])
+                        if change == 'added':
+                            added_user_ids.add(entry[u'id'])
+                    elif kind == 'channel':
+                        changes[self.add_channel(entry)] += 1
+                        channel_ids.add(entry[u'id'])
+                    elif kind == 'im':
+                        ims[entry[u'user']] = entry[u'id']
+            finally:
+                self._loading_ids = None
+
+            for user_id in set(self.users) - user_ids:
+                self.remove_user(user_id)
+                changes['removed'] += 1
+            for channel_id in set(self.channels) - channel_ids:
+                self.remove_channel(channel_id)
+                changes['removed'] += 1
+            for user in self.users.itervalues():
+                im = ims.get(user.id)
+                if user.im != im:
+                    self.set_im(user.id, im)
+                    if user.id not in added_user_ids:
+                        changes['changed'] += 1
+        del changes[None]
+        return changes
+
+    def snapshot(self):
+        """
+        Get the contents of the directory in a compact, JSON-friendly
+        form, to be loaded back with `restore`.
+        """
+        with self._lock:
+            return {
+                'users': [[user.id, user.name, user.im] for user in self.users.itervalues()],
+                'channels': [
+                    [channel.id, channel.name, list(channel.members)]
+                    for channel in self.channels.itervalues()
+                ],
+            }
+
+    def restore(self, snapshot):
+        """Load the contents of the directory from a `snapshot`."""
+        return self.load(itertools.chain(
+            (('user', {u'id': id_, u'name': name}) for id_, name, _ in snapshot['users']),
+            (('im', {u'id': im, u'user': id_}) for id_, _, im in snapshot['users'] if im),
+            (('channel', {u'id': id_, u'name': name, u'members': members})
+             for id_, name, members in snapshot['channels']),
+        ))
+
+    def _intern(self, user_id):
+        """
+        Get the directory's own copy of a user id, so each id is only
+        held in memory once no matter how many channels reference it.
+        """
+        user = self.users.get(user_id)
+        if user is not None:
+            return user.id
+        if self._loading_ids is not None:
+            # Channels may be loaded before their members.
+            return self._loading_ids.setdefault(user_id, user_id)
+        return user_id
+
+    # Users
+    def add_user(self, user):
+        """
+        Add a new user, or update an existing one, from a Slack user
+        object. Returns 'added' or 'changed', or None if nothing changed.
+        """
+        with self._lock:
+            user_id = self._intern(user[u'id'])
+            old_user = self.users.get(user_id)
+            if old_user is not None:
+                if old_user.name == user[u'name']:
+                    return None
+                if self._user_ids.get(old_user.name) == user_id:
+                    del self._user_ids[old_user.name]
+                old_user.name = user[u'name']
+                change = 'changed'
+            else:
+                self.users[user_id] = User(user_id, user[u'name'])
+                change = 'added'
+            self._user_ids[user[u'name']] = user_id
+            return change
+
+    def remove_user(self, user_id):
+        with self._lock:
+            user = self.users.pop(user_id, None)
+            if user is None:
+                return
+            if self._user_ids.get(user.name) == user_id:
+                del self._user_ids[user.name]
+            if user.im:
+                self._im_users.pop(user.im, None)
+
+    def set_im(self, user_id, channel_id):
+        """
+        Record the direct message channel between the bot and a user,
+        or that there isn't one if `channel_id` is None.
+        """
+        with self._lock:
+            user = self.users.get(user_id)
+            if user is None:
+                return
+            if user.im:
+                self._im_users.pop(user.im, None)
+            user.im = channel_id
+            if channel_id:
+                self._im_users[channel_id] = user.id
+
+    def user_details(self, user_id):
+        """Fetch the full Slack user object for a user."""
+        return self._fetch('users.info', dict(user=user_id))[u'user']
+
+    def get_user(self, user_id):
+        try:
+            return self.users.get(user_id)
+        except TypeError:  # some events carry the whole user here
+            return None
+
+    def get_user_by_name(self, name):
+        return self.users.get(self._user_ids.get(name))
+
+    def get_user_by_im(self, channel_id):
+        return self.users.get(self._im_users.get(channel_id))
+
+    def user_names(self):
+        return self._user_ids.keys()
+
+    # Channels
+    def add_channel(self, channel):
+        """
+        Add a new channel, or update an existing one, from a Slack
+        channel object. Returns 'added' or 'changed', or None if nothing
+        changed.
+        """
+        with self._lock:
+            channel_id = channel[u'id']
+            members = channel.get(u'members')
+            if members is not None:
+                members = tuple(self._intern(member) for member in members)
+            old_channel = self.channels.get(channel_id)
+            if old_channel is not None:
+                if (old_channel.name == channel[u'name'] and
+                        members in (None, old_channel.members)):
+                    return None
+                if self._channel_ids.get(old_channel.name) == channel_id:
+                    del self._channel_ids[old_channel.name]
+                old_channel.name = channel[u'name']
+                if members is not None:
+                    old_channel.members = members
+                change = 'changed'
+            else:
+                self.channels[channel_id] = Channel(channel_id, channel[u'name'], members or ())
+                change = 'added'
+            self._channel_ids[channel[u'name']] = channel_id
+            return change
+
+    def remove_channel(self, channel_id):
+        with self._lock:
+            channel = self.channels.pop(channel_id, None)
+            if channel is not None and self._channel_ids.get(channel.name) == channel_id:
+                del self._channel_ids[channel.name]
+
+    def rename_channel(self, channel_id, name):
+        with self._lock:
+            channel = self.channels.get(channel_id)
+            if channel is None:
+                return
+            if self._channel_ids.get(channel.name) == channel_id:
+                del self._channel_ids[channel.name]
+            channel.name = name
+            self._channel_ids[name] = channel.id
+
+    def get_channel(self, channel_id):
+        try:
+            return self.channels.get(channel_id)
+        except TypeError:  # some events carry the whole channel here
+            return None
+
+    def get_channel_by_name(self, name):
+        return self.channels.get(self._channel_ids.get(name))
+
+    def channel_names(self):
+        return self._channel_ids.keys()
+
+    def channel_details(self, channel_id):
+        """Fetch the full Slack channel object for a channel."""
+        return self._fetch('channels.info', dict(channel=channel_id))[u'channel']
@@ -0,0 +1,197 @@
+import collections
+import threading
+import time
+
+import util
+
+# Events are handled in order of priority, lowest first, and in the
+# order they came in within a priority. The chatter of presence and
+# typing updates, which is safe to shed, goes after everything else.
+# Everything else keeps its order, since handling a message can depend
+# on bookkeeping events (team_join, channel_created, user_change...)
+# that came before it.
+PRIORITIES = {
+    u'presence_change': 1,
+    u'user_typing': 1,
+}
+DEFAULT_PRIORITY = 0
+LEVELS = 2
+
+# Fields identifying events of a type that a newer such event makes
+# redundant, so only the latest needs handling.
+COALESCED = {
+    u'presence_change': (u'user',),
+    u'user_typing': (u'channel', u'user'),
+}
+
+OVERFLOW_POLICIES = ('drop', 'block')
+
+
+class Deduplicator(object):
+    """
+    Remembers the last `size` events seen, by type, channel, and
+    timestamp, to spot ones Slack delivers again (as it may after a
+    reconnect). Events without a timestamp are never considered seen.
+    """
+    def __init__(self, size=5000):
+        self.size = size
+        self._seen = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.checked = 0
+        self.hits = 0
+
+    def seen(self, event):
+        """Determine if the event's been seen before, remembering it if not."""
+        ts = event.get(u'ts') or event.get(u'event_ts')
+        if ts is None:
+            return False
+        channel = event.get(u'channel')
+        if isinstance(channel, dict):  # e.g. channel_created's channel object
+            channel = channel.get(u'id')
+        key = (event.get(u'type'), channel, ts)
+        with self._lock:
+            self.checked += 1
+            if key in self._seen:
+                self.hits += 1
+                return True
+            self._seen[key] = None
+            if len(self._seen) > self.size:
+                self._seen.popitem(last=False)
+        return False
+
+    def stats(self):
+        return ["duplicates: {} of {} events ({:.2%})".format(
+            self.hits, self.checked, float(self.hits) / max(self.checked, 1))]
+
+
+class EventQueue(object):
+    """
+    A bounded queue of incoming events, handed out by priority.
+
+    Once `maxsize` events are waiting, the `overflow` policy decides
+    what happens to more: 'drop' discards the oldest event of the lowest
+    priority waiting (possibly the new one), while 'block' makes `put`
+    wait for room.
+
+    Like Queue.Queue, each event taken with `get` must be marked done
+    with `task_done`, and `join` waits until every event has been.
+    """
+    def __init__(self, maxsize=10000, overflow='drop'):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError("overflow must be one of {}".format(', '.join(OVERFLOW_POLICIES)))
+        self.maxsize = maxsize
+        self.overflow = overflow
+        self._levels = [collections.deque() for _ in xrange(LEVELS)]  # of [event, put time]
+        self._coalescable = {}  # (type, field values): entry waiting in a level
+        self._size = 0
+        self._unfinished = 0
+        self._lock = threading.Lock()
+        self._not_empty = threading.Condition(self._lock)
+        self._not_full = threading.Condition(self._lock)
+        self._all_done = threading.Condition(self._lock)
+
+        self.dwell = util.Histogram()  # seconds events spent waiting
+        self.max_depth = 0
+        self.coalesced = 0
+        self.dropped = collections.Counter()  # by event type
+
+    def __len__(self):
+        return self._size
+
+    def put(self, event):
+        event_type = event.get(u'type')
+        key = None
+        if event_type in COALESCED:
+            key = (event_type,) + tuple(event.get(field) for field in COALESCED[event_type])
+        with self._lock:
+            entry = self._coalescable.get(key) if key is not None else None
+            if entry is not None:
+                # Take the waiting event's place in line.
+                entry[0] = event
+                self.coalesced += 1
+                return
+
+            priority = PRIORITIES.get(event_type, DEFAULT_PRIORITY)
+            if self._size >= self.maxsize:
+                if self.overflow == 'block':
+                    while self._size >= self.maxsize:
+                        self._not_full.wait()
+                elif not self._drop_below(priority):
+                    self.dropped[event_type] += 1
+                    return
+
+            entry = [event, time.time()]
+            self._levels[priority].append(entry)
+            if key is not None:
+                self._coalescable[key] = entry
+            self._size += 1
+            self._unfinished += 1
+            self.max_depth = max(self.max_depth, self._size)
+            self._not_empty.notify()
+
+    def _drop_below(self, priority):
+        """
+        Discard the oldest event of the lowest priority waiting, if it's
+        no more important than `priority`. Returns whether one was.
+        """
+        for level in xrange(LEVELS - 1, priority - 1, -1):
+            if self._levels[level]:
+                event = self._take(level)
+                self.dropped[event.get(u'type')] += 1
+                self._finish()
+                return True
+        return False
+
+    def _take(self, level):
+        event, _ = entry = self._levels[level].popleft()
+        event_type = event.get(u'type')
+        if event_type in COALESCED:
+            key = (event_type,) + tuple(event.get(field) for field in COALESCED[event_type])
+            if self._coalescable.get(key) is entry:
+                del self._coalescable[key]
+        self._size -= 1
+        self._not_full.notify()
+        return entry[0]
+
+    def get(self):
+        """Take the next event, waiting for one if there are none."""
+        with self._lock:
+            while not self._size:
+                self._not_empty.wait()
+            level = next(i for i, events in enumerate(self._levels) if events)
+            self.dwell.record(time.time() - self._levels[level][0][1])
+            return self._take(level)
+
+    def task_done(self):
+        with self._lock:
+            self._finish()
+
+    def _finish(self):
+        self._unfinished -= 1
+        if not self._unfinished:
+            self._all_done.notify_all()
+
+    def join(self, timeout=None):
+        """
+        Wait until every event has been handled. Returns the number of
+        events still unhandled after `timeout` seconds.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self._lock:
+            while self._unfinished:
+                if deadline is None:
+                    self._all_done.wait()
+                elif time.time() >= deadline:
+                    break
+                else:
+                    self._all_done.wait(deadline - time.time())
+            return self._unfinished
+
+    def stats(self):
+        return [
+            "events: {} waiting (max {}), {} coalesced, {} dropped ({})".format(
+                self._size, self.max_depth, self.coalesced, sum(self.dropped.itervalues()),
+                ", ".join("{} {}".format(count, event_type)
+                          for event_type, count in self.dropped.most_common(3))),
+            "event wait: {}".format(self.dwell),
+        ]
@@ -0,0 +1,186 @@
+"""
+Events received from Slack.
+
+Run this module on a file of newline-delimited frames (as recorded with
+`record_frames` in the config) to compare what it costs to make events
+of them, and to read their fields, against plain dicts:
+
+    python events.py data/frames.jsonl
+"""
+import re
+import sys
+import time
+
+import codec
+import util
+
+_LINK = re.compile(r'<(http[^>]+)>')
+_ABSENT = object()
+
+
+def _channel_name(event):
+    channel = event._fields.get(u'channel')
+    if not isinstance(channel, basestring):  # e.g. channel_created's channel object
+        return _ABSENT
+    return event.bot.get_channel_name(channel)
+
+
+def _user_name(event):
+    user = event._fields.get(u'user')
+    if not isinstance(user, basestring):  # e.g. user_change's user object
+        return _ABSENT
+    return event.bot.get_nick(user) or _ABSENT
+
+
+# Fields derived from an event's own, by the functions to derive them.
+DERIVED_FIELDS = {
+    u'channel_name': _channel_name,
+    u'user_name': _user_name,
+}
+
+
+class Event(object):
+    """
+    An event received from Slack, read and written like a dict.
+
+    The event wraps the dict it was decoded into rather than copying
+    it, so making one costs next to nothing. Reading `channel_name` or
+    `user_name` looks them up the first time, so events nothing reads
+    them from don't pay for it. They're missing if the event has no
+    channel or user to look up.
+    """
+    __slots__ = ('bot', '_fields', '_parsed')
+
+    def __init__(self, bot, fields):
+        self.bot = bot
+        self._fields = fields
+        self._parsed = None  # (text, its tokens, its flattenings)
+        text = fields.get(u'text')
+        if isinstance(text, basestring) and u'<http' in text:
+            fields[u'text'] = _LINK.sub(r'\1', text)
+
+    def _parse(self):
+        text = self._fields.get(u'text')
+        if not isinstance(text, basestring):
+            text = u''
+        parsed = self._parsed
+        if parsed is None or parsed[0] is not text:
+            parsed = self._parsed = (text, util.tokenize(text), {})
+        return parsed
+
+    @property
+    def tokens(self):
+        """The event's text as util.Tokens, tokenized once."""
+        return self._parse()[1]
+
+    def flatten(self, fragment=None, **kwargs):
+        """
+        Flatten the event's text, or a fragment of it (like a group a
+        rule captured), as util.flatten_incoming_text would. Results
+        are remembered, and fragments are rendered from the text's
+        tokens where possible rather than tokenized again.
+        """
+        text, tokens, flattened = self._parse()
+        key = (fragment, tuple(sorted(kwargs.iteritems()))) if kwargs else fragment
+        result = flattened.get(key)
+        if result is None:
+            renderers = util.flatten_renderers(**kwargs)
+            start = 0 if fragment is None else text.find(fragment)
+            if start >= 0:
+                end = len(text) if fragment is None else start + len(fragment)
+                result = util.render_span(self.bot, tokens, start, end, renderers)
+            if result is None:
+                result = util.render_tokens(self.bot, util.tokenize(fragment), renderers)
+            flattened[key] = result
+        return result
+
+    def __getitem__(self, key):
+        try:
+            return self._fields[key]
+        except KeyError:
+            return self.__missing__(key)
+
+    def __missing__(self, key):
+        derive = DERIVED_FIELDS.get(key)
+        value = _ABSENT if derive is None else derive(self)
+        if value is _ABSENT:
+            raise KeyError(key)
+        self._fields[key] = value
+        return value
+
+    def get(self, key, default=None):
+        value = self._fields.get(key, _ABSENT)
+        if value is not _ABSENT:
+            return value
+        if key not in DERIVED_FIELDS:
+            return default
+        try:
+            return self.__missing__(key)
+        except KeyError:
+            return default
+
+    def pop(self, key, *default):
+        return self._fields.pop(key, *default)
+
+    def __setitem__(self, key, value):
+        self._fields[key] = value
+
+    def __delitem__(self, key):
+        del self._fields[key]
+
+    def __contains__(self, key):
+        return key in self._fields
+
+    def keys(self):
+        return self._fields.keys()
+
+    def iteritems(self):
+        return self._fields.iteritems()
+
+    def items(self):
+        return self._fields.items()
+
+    def __iter__(self):
+        return iter(self._fields)
+
+    def __len__(self):
+        return len(self._fields)
+
+    def __repr__(self):
+        return repr(self._fields)
+
+
+def _measure(make, fields_list):
+    """
+    Get the seconds it takes `make` to turn each fields into an event,
+    the seconds it takes to `get` a field of one, and the bytes each
+    takes up.
+    """
+    started = time.time()
+    made = [make(fields) for fields in fields_list]
+    elapsed = time.time() - started
+    started = time.time()
+    for event in made:
+        event.get(u'type')
+        event.get(u'subtype')
+    lookup = (time.time() - started) / 2
+    size = 0
+    for event in made:
+        size += sys.getsizeof(event)
+        fields = getattr(event, '_fields', None)
+        if fields is not None:
+            size += sys.getsizeof(fields)
+    return elapsed / len(made), lookup / len(made), float(size) / len(made)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 2:
+        print "Usage: python events.py FRAMES_FILE"
+        sys.exit(1)
+    with open(sys.argv[1]) as f:
+        fields_list = [codec.loads(line) for line in f if line.strip()]
+    print "{} events".format(len(fields_list))
+    for name, make in [('dict', dict), ('Event', lambda fields: Event(None, fields))]:
+        seconds, lookup, size = _measure(make, fields_list)
+        print "{:>6}: {:.2f}us to make, {:.2f}us per get, and {:.0f} bytes per event".format(
+            name, seconds * 1e6, lookup * 1e6, size)
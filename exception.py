@@ -8,3 +8,9 @@ class MessageTooLongException(SlackbotException):
     """
     Tried to send a message that was too long from SlackBot.
     """
+
+
+class WorkerPoolFullException(SlackbotException):
+    """
+    Tried to run a threaded command while the worker pool was full.
+    """
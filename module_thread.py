@@ -2,26 +2,41 @@
 Util for threading bot commands.
 """
 
+import collections
 import functools
 import threading
+import time
+import traceback
+
+import exception
 
 
 threads = []
 
 
-def join_threads():
+def join_threads(timeout=None):
     """
     Wait for threaded commands to clean themselves up.
 
     This is achieved by requesting each of them to stop, then waiting
     until each of them has stopped. It is the thread's responsibility
-    to stop in a timely manner.
+    to stop in a timely manner. The worker pool stops accepting new
+    work, and its workers exit once they've drained its queue.
+
+    If `timeout` is given, stop waiting after that many seconds. Returns
+    the threads that have not stopped.
     """
+    pool.shutdown()
     _threads = threads[:]
     for thread in _threads:
         thread.stop()
+    deadline = None if timeout is None else time.time() + timeout
     for thread in _threads:
-        thread.join()
+        if deadline is None:
+            thread.join()
+        else:
+            thread.join(max(0, deadline - time.time()))
+    return [thread for thread in _threads if thread.is_alive()]
 
 
 def _register(thread, target):
@@ -57,3 +72,116 @@ class StoppableThread(threading.Thread):
 
     def __str__(self):
         return self._target.__name__
+
+
+class WorkerPool(object):
+    """
+    A bounded pool of StoppableThreads to run threaded commands on.
+
+    At most `max_workers` threads are started, lazily, as work comes
+    in. At most `max_queue` tasks may wait for a free worker; past
+    that, `submit` either raises `WorkerPoolFullException` (when
+    `overflow` is 'reject') or blocks until there is room (when
+    `overflow` is 'queue').
+
+    If `ordered` is set, tasks submitted with the same key (eg, the
+    same channel) run one at a time, in the order they were submitted.
+    """
+    def __init__(self, max_workers=8, max_queue=32, overflow='reject', ordered=False):
+        if overflow not in ('reject', 'queue'):
+            raise ValueError("overflow must be 'reject' or 'queue'")
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self.overflow = overflow
+        self.ordered = ordered
+
+        self._condition = threading.Condition()
+        self._queue = collections.deque()  # tasks ready to run
+        self._waiting = {}  # key: tasks waiting on a running task of that key
+        self._pending = 0  # tasks submitted but not yet started
+        self._workers = []
+        self._idle = 0
+        self._closed = False
+
+    def submit(self, fn, args=(), key=None):
+        """Queue `fn(*args)` to run on a worker thread."""
+        if not self.ordered:
+            key = None
+        with self._condition:
+            if self._closed:
+                raise exception.WorkerPoolFullException("The worker pool is shut down.")
+            while self._pending >= self.max_queue:
+                if self.overflow == 'reject':
+                    raise exception.WorkerPoolFullException(
+                        "{} tasks are already waiting.".format(self._pending))
+                self._condition.wait()
+            task = (fn, args, key)
+            self._pending += 1
+            if key is not None and key in self._waiting:
+                self._waiting[key].append(task)
+                return
+            if key is not None:
+                self._waiting[key] = collections.deque()
+            self._queue.append(task)
+            self._grow()
+            self._condition.notify()
+
+    def _grow(self):
+        """
+        Start another worker if more tasks are ready than there are idle
+        workers to take them (idle workers already woken for a task still
+        count as idle until they take it).
+        """
+        if len(self._queue) > self._idle and len(self._workers) < self.max_workers:
+            worker = StoppableThread(target=self._work)
+            worker.setDaemon(True)  # idle workers shouldn't hold up exit
+            self._workers.append(worker)
+            worker.start()
+
+    def shutdown(self):
+        """
+        Stop accepting new tasks. Workers exit once the queue is empty.
+        """
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+
+    @property
+    def depth(self):
+        """The number of tasks waiting to start."""
+        return self._pending
+
+    def _work(self):
+        while 1:
+            with self._condition:
+                self._idle += 1
+                while not self._queue and not self._closed:
+                    self._condition.wait()
+                self._idle -= 1
+                if not self._queue:
+                    self._workers.remove(threading.current_thread())
+                    return
+                fn, args, key = self._queue.popleft()
+                self._pending -= 1
+                self._condition.notify_all()  # there's room for blocked submitters
+            try:
+                fn(*args)
+            except Exception:
+                traceback.print_exc()
+            finally:
+                if key is not None:
+                    self._release(key)
+
+    def _release(self, key):
+        """Let the next task waiting on `key` run, if any."""
+        with self._condition:
+            waiting = self._waiting[key]
+            if waiting:
+                self._queue.append(waiting.popleft())
+                self._grow()
+                self._condition.notify()
+            else:
+                del self._waiting[key]
+
+
+pool = WorkerPool()
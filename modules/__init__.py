@@ -3,33 +3,99 @@ from __future__ import absolute_import
 import collections
 import functools
 import inspect
-import json
 import re
 import time
 
+import codec
+import exception
 import module_thread
 import util
 
 
 UNSET = object()
 
+# Weight of each new run in a command's running average runtime, and
+# how many runs it takes before the average can move the command.
+RUNTIME_WEIGHT = 0.2
+RUNTIME_SAMPLES = 5
+
+# Characters that stand for themselves in a rule, for prefiltering.
+_LITERAL_RULE = re.compile(r"[\w :,'-]*")
+_MENTION_SEPARATOR = re.compile(r"(?:\\s\+| +)")
+_INLINE_FLAGS = re.compile(r"\(\?[iLmsux]+\)")
+
+
+def _has_top_level_branch(rule):
+    """Determine if the regex string `rule` alternates at its top level."""
+    depth = 0
+    i = 0
+    while i < len(rule):
+        char = rule[i]
+        if char == '\\':
+            i += 1
+        elif char == '[':
+            # Skip the character class. A leading ']' is a literal.
+            i += 1
+            if rule[i:i + 1] == '^':
+                i += 1
+            if rule[i:i + 1] == ']':
+                i += 1
+            while i < len(rule) and rule[i] != ']':
+                if rule[i] == '\\':
+                    i += 1
+                i += 1
+        elif char == '(':
+            depth += 1
+        elif char == ')':
+            depth -= 1
+        elif char == '|' and depth == 0:
+            return True
+        i += 1
+    return False
+
+
+def _mention_prefix(rule):
+    """
+    Find what a rule demands from the start of a message, for cheaply
+    ruling out messages before running the full regex.
+
+    Returns None if the rule doesn't demand that the message open by
+    pinging the bot. Otherwise returns the literal text (possibly empty)
+    the rule requires directly after the ping and any whitespace.
+    """
+    if isinstance(rule, list):
+        rule = r'\s+'.join(rule)
+    if not isinstance(rule, basestring) or not rule.startswith(r"$@bot"):
+        return None
+    if _INLINE_FLAGS.search(rule) or _has_top_level_branch(rule):
+        return None
+    separator = _MENTION_SEPARATOR.match(rule, len(r"$@bot"))
+    if not separator:
+        return ''
+    literal = _LITERAL_RULE.match(rule, separator.end())
+    prefix = literal.group(0)
+    if rule[literal.end():literal.end() + 1] in ('?', '*', '+', '{'):
+        prefix = prefix[:-1]  # the last character is optional
+    return prefix
 
-class BotCommand(object):
-    RULE_VERSION = 0
 
+class BotCommand(object):
     def __init__(
             self, fn,
             rule=UNSET, actions=["message"], priority=0, sender=None,
             ttl=False, activations=False, name=None, threaded=False,
-            hide=False, occludes=True, occludable=True, fields=None):
+            hide=False, occludes=True, occludable=True, fields=None, offloadable=True,
+            config_flag=None, pooled=True):
         """
         TODO: This needs documentation like real badly.
         """
         self._fn = fn
 
         self._rule = rule  # unmodified base rule, for reference
-        self._compiled_rule = None  # regex object to match against
-        self._rule_version = None
+        self.rule = None  # regex object to match against, once compiled
+        # literal text a message must open with after pinging the bot,
+        # or None if the rule doesn't demand a ping.
+        self.mention_prefix = _mention_prefix(rule)
 
         self._sender = sender  # unmodified base sender, for reference
         self._compiled_sender = None  # regex object to match against
@@ -47,10 +113,21 @@ class BotCommand(object):
             self.activations = False
 
         self.threaded = threaded
+        # Threaded commands that run for the life of the bot get a thread
+        # of their own rather than holding one of the worker pool's.
+        self.pooled = pooled
+        # Commands that turn out to be slow are moved off the dispatcher
+        # thread onto the worker pool, unless they're not offloadable.
+        self.offloadable = offloadable
+        self.offloaded = False
+        self.runtime = 0.0  # moving average, in seconds, of its runs
+        self.runs = 0
         self.hide = hide
         self.occludes = occludes
         self.occludable = occludable
         self.fields = fields or {}
+        # bot config setting that must be on for the command to activate
+        self.config_flag = config_flag
         functools.update_wrapper(self, fn)
 
     @property
@@ -73,45 +150,44 @@ class BotCommand(object):
             self._compiled_sender = re.compile(sender)
         return self._compiled_sender
 
-    @property
-    def rule(self):
+    def compile(self, user, user_name):
         """
-        Get the regex that matches input on which to trigger.
-        If the regex does not exist or is out of date, generates it.
+        Compile the rule to match input on, with the given identity
+        substituted for references to the bot. Raises re.error or
+        ValueError if the rule is invalid.
 
         $bot - Bot nick
         $@bot - Bot ping
         """
         if self._rule is UNSET:
-            return UNSET
-        if self._compiled_rule is None or self._rule_version != BotCommand.RULE_VERSION:
-            if self._rule is None:
-                rule = r".*"
-            elif isinstance(self._rule, basestring):
-                rule = self._rule
-            elif isinstance(self._rule, list):
-                rule = r'\s+'.join(self._rule)
-            else:
-                raise ValueError("invalid rule format")
+            self.rule = UNSET
+            return
+        if self._rule is None:
+            rule = r".*"
+        elif isinstance(self._rule, basestring):
+            rule = self._rule
+        elif isinstance(self._rule, list):
+            rule = r'\s+'.join(self._rule)
+        else:
+            raise ValueError("invalid rule format")
 
-            for keyword, replacement in [
-                    (r"$bot", self.bot.user_name),
-                    (r"$@bot", r"<@{}>:?".format(self.bot.user)),
-                    (r"$yes", r"(?:yes|yup|yeah|uh huh)"),
-                    (r"$no", r"(?:nope|no|nah|nuh uh)"),
-                    (r"$@user", r"<@U\w+>:?"),
-                    (r"$(@user)", r"<@(U\w+)>:?")]:
-                rule = rule.replace(keyword, replacement)
+        for keyword, replacement in [
+                (r"$bot", user_name or ''),
+                (r"$@bot", r"<@{}>:?".format(user)),
+                (r"$yes", r"(?:yes|yup|yeah|uh huh)"),
+                (r"$no", r"(?:nope|no|nah|nuh uh)"),
+                (r"$@user", r"<@U\w+>:?"),
+                (r"$(@user)", r"<@(U\w+)>:?")]:
+            rule = rule.replace(keyword, replacement)
 
-            self._rule_version = BotCommand.RULE_VERSION
-            self._compiled_rule = re.compile(rule, re.DOTALL)
-        return self._compiled_rule
+        self.rule = re.compile(rule, re.DOTALL)
 
     def matches(self, bot, msg):
         """Determine if the given message should trigger this command."""
-        self.bot = bot
         if msg.get('type') not in self.actions:
             return False
+        if self.config_flag is not None and not bot.config.get(self.config_flag):
+            return False
         if self.occludable and u'occluded' in msg:
             return False
         if self.fields:
@@ -132,15 +208,126 @@ class BotCommand(object):
             self.activations -= 1
         if self.occludes:
             msg[u'occluded'] = True
-        if self.threaded:
+        if self.threaded and not self.pooled:
             module_thread.StoppableThread(target=self._fn, args=(bot, msg) + args).start()
+        elif self.threaded or self.offloaded:
+            fn = self._fn if self.threaded else self._run_offloaded
+            try:
+                module_thread.pool.submit(fn, (bot, msg) + args, key=msg.get(u'channel'))
+            except exception.WorkerPoolFullException as e:
+                bot.debug("Rejected {}: {}".format(self, e), 'yellow')
+                # Only tell people about commands they'd expect an answer from.
+                if self.threaded and not self.hide and u'channel' in msg:
+                    bot.reply("I'm swamped right now, try again in a bit.")
         else:
             return self._fn(bot, msg, *args)
 
+    def _run_offloaded(self, bot, msg, *args):
+        """Run the command on the worker pool, still timing it."""
+        started = time.time()
+        try:
+            self._fn(bot, msg, *args)
+        finally:
+            if self.record_runtime(time.time() - started, bot.config['dispatch_budget']):
+                bot.debug("{} is averaging {:.2f}s, moving it back onto the dispatcher thread.".format(
+                    self, self.runtime), 'yellow')
+
+    def record_runtime(self, seconds, budget):
+        """
+        Track how long a run of the command took, in an exponentially
+        weighted moving average of its runs.
+
+        Once there have been enough runs to go on, a command averaging
+        more than `budget` seconds is moved onto the worker pool, and
+        one averaging less than half of it is moved back. Returns True
+        if the command has just been moved either way.
+        """
+        self.runs += 1
+        if self.runs == 1:
+            self.runtime = seconds
+        else:
+            self.runtime += RUNTIME_WEIGHT * (seconds - self.runtime)
+        if not self.offloadable or self.runs < RUNTIME_SAMPLES:
+            return False
+        if not self.offloaded and self.runtime > budget:
+            self.offloaded = True
+            return True
+        if self.offloaded and self.runtime < budget / 2.:
+            self.offloaded = False
+            return True
+        return False
+
     def __repr__(self):
         return self._fn.__name__
 
 
+class CommandTable(object):
+    """
+    An immutable, priority-ordered snapshot of registered commands,
+    indexed by the actions they activate on.
+
+    Registering or unregistering commands builds a new table instead
+    of modifying this one, so the dispatcher can walk a table without
+    copying it while commands come and go on other threads.
+    """
+    def __init__(self, commands=()):
+        self.commands = tuple(sorted(commands, key=lambda cmd: -cmd.priority))
+        self._members = frozenset(self.commands)
+
+        by_action = collections.defaultdict(list)
+        unmentioned_by_action = collections.defaultdict(list)
+        flags_by_action = collections.defaultdict(set)
+        for command in self.commands:
+            for action in set(command.actions):
+                by_action[action].append(command)
+                flags_by_action[action].add(command.config_flag)
+                if command.mention_prefix is None:
+                    unmentioned_by_action[action].append(command)
+        self._by_action = {action: tuple(cmds) for action, cmds in by_action.iteritems()}
+        self._unmentioned_by_action = {
+            action: tuple(cmds) for action, cmds in unmentioned_by_action.iteritems()}
+        self._flags_by_action = {
+            action: frozenset(flags) for action, flags in flags_by_action.iteritems()}
+
+    def with_commands(self, commands):
+        """Get a new table with the given commands added."""
+        return CommandTable(self.commands + tuple(commands))
+
+    def without_commands(self, commands):
+        """Get a new table with the given commands removed."""
+        commands = set(commands)
+        return CommandTable(cmd for cmd in self.commands if cmd not in commands)
+
+    def get(self, action, mentioned=True):
+        """
+        Get the commands that may activate on the given action, in
+        priority order. If `mentioned` is False, commands that demand
+        the bot be pinged are left out.
+        """
+        if mentioned:
+            return self._by_action.get(action, ())
+        return self._unmentioned_by_action.get(action, ())
+
+    def wants(self, action, config):
+        """
+        Determine if any command may activate on the given action, given
+        the bot's config settings.
+        """
+        flags = self._flags_by_action.get(action)
+        if flags is None:
+            return False
+        return None in flags or any(config.get(flag) for flag in flags)
+
+    def __contains__(self, command):
+        return command in self._members
+
+    def __iter__(self):
+        return iter(self.commands)
+
+    def __len__(self):
+        return len(self.commands)
+
+
 class register(object):
     """
     Registers the decorated function as a command of the bot.
@@ -195,13 +382,13 @@ readable_path = 'data/{}.json'
 
 def save_readable(obj, filename, version):
     with open(readable_path.format(filename), 'w') as f:
-        json.dump({'version': version, 'data': obj}, f)
+        codec.dump({'version': version, 'data': obj}, f)
 
 
 def get_readable(filename):
     try:
         with open(readable_path.format(filename)) as f:
-            result = json.load(f)
+            result = codec.load(f)
         return result['version'], result['data']
     except IOError:
         return None, None
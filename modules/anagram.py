@@ -16,7 +16,7 @@ def anagram(bot, msg, to_anagram):
     """
     to_anagram = urllib.quote(to_anagram.encode('utf8'), '')
     query = 'http://www.anagramgenius.com/server.php?source_text={}'.format(to_anagram)
-    result = requests.get(query)
+    result = requests.get(query, timeout=10)
     # Hooray pre-RESTful internet
     anagram = re.search(
         r"<br><span class=\"black-18\">'(.*)'</span></h3>",
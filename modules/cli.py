@@ -1,7 +1,6 @@
 from __future__ import print_function
 
 import contextlib
-import functools
 import readline
 import sys
 import threading
@@ -28,53 +27,50 @@ def get_cli_prefix(bot):
 
 
 # CLI Display methods.
-def _log_message(bot, channel, user, text):
+def _log_message(bot, channel, user, text, tokens=None):
     with util.hilite('cyan'):
         print(channel, end=' ')
     with util.hilite('purple'):
         print(user, end=' ')
-    print(_format_text(bot, text))
+    if tokens is None:
+        tokens = util.tokenize(text)
+    print(util.render_tokens(bot, tokens, _RENDERERS))
 
 
-def _format_user(bot, match):
-    user_id, = match.groups()
-    user = bot.get_nick(user_id)
+def _format_user(bot, token):
+    user = bot.get_nick(token.value)
     if user:
-        if user_id == bot.user and bot.config['terminal_ping']:
+        if token.value == bot.user and bot.config['terminal_ping']:
             user = "{}\a".format(user)
         return util.hilite_string('cyan', "@{}".format(user))
-    return match.group(0)
+    return token.source
 
 
-def _format_channel(bot, match):
-    channel_id, = match.groups()
-    channel = bot.get_channel_name(channel_id)
+def _format_channel(bot, token):
+    channel = bot.get_channel_name(token.value)
     if channel:
-        return util.hilite_string('cyan', "#{}".format(channel))
-    return match.group(0)
+        return util.hilite_string('cyan', channel)
+    return token.source
 
 
-def _format_notice(bot, match):
-    notice, = match.groups()
-    if notice in ('channel', 'everyone', 'group'):
+def _format_notice(bot, token):
+    if token.value in ('channel', 'everyone', 'group'):
         return util.hilite_string('cyan', "@{}{}".format(
-            notice,
+            token.value,
             "\a" if bot.config['terminal_ping'] else ""))
-    return match.group(0)
+    return token.source
 
 
-def _format_link(bot, match):
-    url, = match.groups()
-    return util.hilite_string('blue', url)
+def _format_link(bot, token):
+    return util.hilite_string('blue', token.value)
 
 
-_format_text = functools.partial(
-    util.format_incoming_text,
-    user_fn=_format_user,
-    channel_fn=_format_channel,
-    notice_fn=_format_notice,
-    url_fn=_format_link,
-)
+_RENDERERS = {
+    util.USER: _format_user,
+    util.CHANNEL: _format_channel,
+    util.NOTICE: _format_notice,
+    util.URL: _format_link,
+}
 
 
 # CLI outgoing
@@ -107,6 +103,11 @@ def _bot(bot, command):
     print(eval(' '.join(command[1:])))
 
 
+def _stats(bot, command):
+    with util.hilite('gray'):
+        print('\n'.join(bot.stats()) or "No stats yet.")
+
+
 def _unknown_command(bot, command):
     with util.hilite('gray'):
         print("Unknown command '{}'".format(command[0]))
@@ -115,7 +116,7 @@ def _unknown_command(bot, command):
 def _setup_autocompletion(bot):
     def completer(text, state):
         if text.startswith('@'):
-            users = (user[u'name'] for user in bot.users.itervalues())
+            users = bot.directory.user_names()
             matched = [user for user in users if user.startswith(text[1:])]
         elif text.startswith('#'):
             matched = [channel for channel in bot.get_channel_names() if channel.startswith(text[1:])]
@@ -148,8 +149,15 @@ def _get_debug_fn(bot):
     return debug_fn
 
 
-@modules.register(actions=['hello'], threaded=True, hide=True, occludes=False, priority=100)
+_cli_running = threading.Lock()  # held by the one cli_input thread
+
+
+@modules.register(
+    actions=['hello'], threaded=True, pooled=False, hide=True, occludes=False, priority=100)
 def cli_input(bot, msg):
+    # Slack says hello again on every reconnect; keep to one prompt.
+    if not _cli_running.acquire(False):
+        return
     bot.set_debug_fn(_get_debug_fn(bot))
     current_thread = threading.current_thread()
     _setup_autocompletion(bot)
@@ -157,6 +165,7 @@ def cli_input(bot, msg):
         'bot': _bot,
         'channel': _channel,
         'show_typing': _config_boolean('show_typing', "Show typing", False),
+        'stats': _stats,
         'terminal_ping': _config_boolean('terminal_ping', "Terminal ping", True),
     }
     while 1:
@@ -178,18 +187,19 @@ def cli_input(bot, msg):
 # ===
 
 
-@modules.register(rule=r'.*', hide=True, occludes=False, priority=10)
+@modules.register(rule=r'.*', hide=True, occludes=False, priority=10, offloadable=False)
 def log_message(bot, msg):
     """
     Print to the terminal a message that someone has written.
     """
     msg[u'_logged'] = True
     with autoflush(bot):
-        _log_message(bot, msg[u'channel_name'], msg[u'user_name'], msg[u'text'])
+        _log_message(bot, msg[u'channel_name'], msg[u'user_name'], msg[u'text'], msg.tokens)
 
 
 @modules.register(
-    actions=[None], hide=True, occludes=False, fields=dict(reply_to=any), priority=10)
+    actions=[None], hide=True, occludes=False, fields=dict(reply_to=any), priority=10,
+    offloadable=False)
 def log_received(bot, msg):
     """
     Print to the terminal a message the bot has said.
@@ -199,24 +209,26 @@ def log_received(bot, msg):
         _log_message(bot, bot.get_channel_name(msg[u'channel']), bot.user_name, msg[u'text'])
 
 
-@modules.register(actions=['user_typing'], occludes=False, hide=True, priority=10)
+@modules.register(
+    actions=['user_typing'], occludes=False, hide=True, priority=10, config_flag='show_typing',
+    offloadable=False)
 def log_typing(bot, msg):
     """
     Print to the terminal that a user is typing.
 
-    Note that if the bot config `show_typing` is False
-    nothing will be logged.
+    Note that if the bot config `show_typing` is False, typing events
+    are ignored altogether.
     """
     msg[u'_logged'] = True
-    if bot.config.get('show_typing'):
-        with autoflush(bot), util.hilite('gray'):
-            if msg[u'channel_name'].startswith('#'):
-                print('{} is typing in {}.'.format(msg[u'user_name'], msg[u'channel_name']))
-            else:
-                print('{} is typing to you.'.format(msg[u'user_name']))
+    with autoflush(bot), util.hilite('gray'):
+        if msg[u'channel_name'].startswith('#'):
+            print('{} is typing in {}.'.format(msg[u'user_name'], msg[u'channel_name']))
+        else:
+            print('{} is typing to you.'.format(msg[u'user_name']))
 
 
-@modules.register(actions=['presence_change'], occludes=False, hide=True, priority=10)
+@modules.register(
+    actions=['presence_change'], occludes=False, hide=True, priority=10, offloadable=False)
 def log_presence_change(bot, msg):
     """
     Print to the terminal that a user has changed presence.
@@ -233,7 +245,9 @@ def log_presence_change(bot, msg):
         print(".")
 
 
-@modules.register(fields=dict(subtype='message_changed'), occludes=False, hide=True, priority=10)
+@modules.register(
+    fields=dict(subtype='message_changed'), occludes=False, hide=True, priority=10,
+    offloadable=False)
 def log_message_changed(bot, msg):
     """
     Print to the terminal that a user's message has been edited.
@@ -255,7 +269,7 @@ def log_message_changed(bot, msg):
         )
 
 
-@modules.register(actions=['star_added'], occludes=False, hide=True, priority=10)
+@modules.register(actions=['star_added'], occludes=False, hide=True, priority=10, offloadable=False)
 def log_starred(bot, msg):
     item = msg[u'item']
     if item[u'type'] in ['message', 'channel', 'file', 'im']:
@@ -266,7 +280,8 @@ def log_starred(bot, msg):
             _print_star_info(bot, msg)
 
 
-@modules.register(actions=['star_removed'], occludes=False, hide=True, priority=10)
+@modules.register(
+    actions=['star_removed'], occludes=False, hide=True, priority=10, offloadable=False)
 def log_unstarred(bot, msg):
     item = msg[u'item']
     if item[u'type'] in ['message', 'channel', 'file', 'im']:
@@ -299,7 +314,7 @@ def _print_star_info(bot, msg):
             print(message)
 
 
-@modules.register(actions=['team_join'], hide=True, occludes=False, priority=10)
+@modules.register(actions=['team_join'], hide=True, occludes=False, priority=10, offloadable=False)
 def log_new_user(bot, msg):
     msg[u'_logged'] = True
     user = msg[u'user']
@@ -309,7 +324,9 @@ def log_new_user(bot, msg):
         print("({}) has joined the team!".format(user[u'real_name']))
 
 
-@modules.register(actions=['file_public', 'file_shared'], hide=True, occludes=False, priority=10)
+@modules.register(
+    actions=['file_public', 'file_shared'], hide=True, occludes=False, priority=10,
+    offloadable=False)
 def log_image(bot, msg):
     permalink = msg[u'file'].get(u'permalink_public')
     if permalink:
@@ -318,7 +335,7 @@ def log_image(bot, msg):
             print(permalink)
 
 
-@modules.register(actions=['user_change'], hide=True, occludes=False, priority=10)
+@modules.register(actions=['user_change'], hide=True, occludes=False, priority=10, offloadable=False)
 def log_user_change(bot, msg):
     if msg[u'user'][u'deleted'] is True:
         msg[u'_logged'] = True
@@ -328,7 +345,9 @@ def log_user_change(bot, msg):
             print("has left the team.")
 
 
-@modules.register(fields=dict(subtype='message_deleted'), occludes=False, hide=True, priority=10)
+@modules.register(
+    fields=dict(subtype='message_deleted'), occludes=False, hide=True, priority=10,
+    offloadable=False)
 def log_message_delete(bot, msg):
     msg[u'_logged'] = True
     with autoflush(bot):
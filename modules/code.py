@@ -1,7 +1,6 @@
 import re
 import requests
 
-import exception
 import modules
 import util
 
@@ -47,7 +46,7 @@ def code(bot, msg, language, _, code):
         "private": "on",
         "lang": supported_languages[language],
         "input": "",
-        "code": util.flatten_incoming_text(bot, code).encode('utf-8'),
+        "code": msg.flatten(code).encode('utf-8'),
     }
     response = requests.post(uri, data)
     bot.debug(response.url)
@@ -56,9 +55,6 @@ def code(bot, msg, language, _, code):
     html = html[5: html.index("</pre>")]
     output = util.unescape(html).rstrip().decode('utf-8')
     if output:
-        try:
-            bot.reply(u"```{}```".format(output))
-        except exception.MessageTooLongException:
-            bot.reply(response.url)
+        bot.reply(u"```{}```".format(output))
     else:
         bot.reply("No output...")
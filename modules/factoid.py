@@ -1,10 +1,9 @@
 import collections
-import json
 import os
 import re
 
+import codec
 import modules
-import util
 
 factoids = None
 
@@ -36,14 +35,14 @@ class FactoidDatabase(collections.MutableMapping):
             self.flush()
 
         with open(self._path) as f:
-            self.update([(k, Factoid(**v)) for (k, v) in json.load(f).items()])
+            self.update([(k, Factoid(**v)) for (k, v) in codec.load(f).items()])
 
     def flush(self):
         with open(self._path, 'wb') as f:
             json_data = dict([
                 (k, factoid.to_json()) for k, factoid in self.items()
             ])
-            json.dump(json_data, f)
+            codec.dump(json_data, f)
 
     def _make_key(self, key):
         return key.strip().lower()
@@ -84,8 +83,8 @@ def set_factoid(bot, msg, key, verb, value):
     `@bot: [key] is <reply>[value]` to have the bot respond with only the
     value instead of repeating "[key] is".
     """
-    key = util.flatten_incoming_text(bot, key)
-    value = util.flatten_incoming_text(bot, value)
+    key = msg.flatten(key)
+    value = msg.flatten(value)
 
     factoid = Factoid(key=key, verb=verb, value=value, reply=False)
 
@@ -102,7 +101,7 @@ def get_factoid(bot, msg, key):
     """
     Get a factoid. Invoked with `foo?` or `foo!` for a factoid named foo.
     """
-    key = util.flatten_incoming_text(bot, key)
+    key = msg.flatten(key)
     if factoids and key in factoids:
         bot.reply(factoids[key])
 
@@ -112,7 +111,7 @@ def forget_factoid(bot, msg, key):
     """
     Forget a factoid. Invoked with `@bot: forget foo` for a factoid named foo.
     """
-    key = util.flatten_incoming_text(bot, key)
+    key = msg.flatten(key)
     try:
         del factoids[key]
         bot.reply('ok')
@@ -9,7 +9,8 @@ MAX_LOGS = 30
 
 
 @modules.register(
-    actions=[None], fields=dict(reply_to=any), priority=20, hide=True, occludes=False)
+    actions=[None], fields=dict(reply_to=any), priority=20, hide=True, occludes=False,
+    offloadable=False)
 def acknowledge_received(bot, msg):
     """
     Acknowledge the server's acknowledgement of message delivery.
@@ -34,34 +35,53 @@ def acknowledge_received(bot, msg):
         bot.previous_messages.pop()
 
 
-@modules.register(actions=['team_join', 'user_change'], hide=True, occludes=False)
+@modules.register(
+    actions=['team_join', 'user_change'], hide=True, occludes=False, offloadable=False)
 def update_user(bot, msg):
     """
     When a user joins the team, the bot needs to know about them so it
     can respond appropriately.
     """
-    user = msg[u'user']
-    bot.users[user[u'id']] = user
+    bot.directory.add_user(msg[u'user'])
 
 
-@modules.register(actions=['im_open'], hide=True, occludes=False)
+@modules.register(actions=['im_open'], hide=True, occludes=False, offloadable=False)
 def im_open(bot, msg):
     """
     When a direct message channel has been opened between the bot and
     another user, the bot needs to know that that's the correct way to
     private message them.
     """
-    bot.users[msg[u'user']][u'im'] = msg[u'channel']
+    bot.directory.set_im(msg[u'user'], msg[u'channel'])
 
 
-@modules.register(actions=['im_close'], hide=True, occludes=False)
+@modules.register(actions=['im_close'], hide=True, occludes=False, offloadable=False)
 def im_close(bot, msg):
     """
     When a direct message channel has been closed between the bot and
     another user, the bot needs to know that that's no longer an option
     private message them.
     """
-    bot.users[msg[u'user']][u'im'] = None
+    bot.directory.set_im(msg[u'user'], None)
+
+
+@modules.register(
+    actions=['channel_created', 'channel_joined'], hide=True, occludes=False, offloadable=False)
+def update_channel(bot, msg):
+    """
+    When a channel is created or the bot joins one, the bot needs to
+    know about it to refer to it by name.
+    """
+    bot.directory.add_channel(msg[u'channel'])
+
+
+@modules.register(actions=['channel_rename'], hide=True, occludes=False, offloadable=False)
+def rename_channel(bot, msg):
+    """
+    When a channel is renamed, the bot needs to know its new name.
+    """
+    channel = msg[u'channel']
+    bot.directory.rename_channel(channel[u'id'], channel[u'name'])
 
 
 @modules.register(rule=[r"$@bot", r"redact"])
@@ -7,7 +7,6 @@ import threading
 import time
 
 import modules
-import util
 
 TERMS_CUTOFF = 10
 DICE_CUTOFF = 100000
@@ -218,7 +217,7 @@ def shuffle(bot, msg, shuffle_string):
        @bot: l, f, i, m, x, p, y, e, e
     """
     CUTOFF = 200
-    shuffle_string = util.flatten_incoming_text(bot, shuffle_string, flatten_notice=False)
+    shuffle_string = msg.flatten(shuffle_string, flatten_notice=False)
     success, shuffle_list = _parse_shuffle_set(bot, shuffle_string)
     if not success:
         bot.reply('\n'.join(shuffle_list))
@@ -235,7 +234,7 @@ def choose(bot, msg, choose_string):
 
     Sequence definition syntax is detailed in `shuffle`.
     """
-    choose_string = util.flatten_incoming_text(bot, choose_string, flatten_notice=False)
+    choose_string = msg.flatten(choose_string, flatten_notice=False)
     success, choose_list = _parse_shuffle_set(bot, choose_string)
     if not success:
         bot.reply('\n'.join(choose_list))
@@ -1,10 +1,51 @@
-import json
+import collections
+import itertools
+import random
+import re
+import resource
+import sys
 import threading
+import time
+import traceback
 
 import requests
+import requests.adapters
 import websocket
 
+import codec
 import config
+import util
+
+try:
+    import ijson
+except ImportError:  # Fall back to reading rtm.start all at once.
+    ijson = None
+
+# Where the directory's entries live in an rtm.start response.
+_RTM_START_ENTRIES = {
+    'users.item': 'user',
+    'channels.item': 'channel',
+    'ims.item': 'im',
+}
+# The other top level fields of rtm.start the bot needs.
+_RTM_START_FIELDS = ('ok', 'error', 'self', 'url')
+
+# Calls per minute Slack allows for each rate limit tier of Web API method.
+_TIER_LIMITS = {1: 1, 2: 20, 3: 50, 4: 100}
+_METHOD_TIERS = {
+    'rtm.start': 1,
+    'im.close': 2,
+    'chat.update': 3,
+    'im.open': 3,
+    'channels.info': 3,
+    'users.info': 4,
+}
+_DEFAULT_TIER = 3
+
+
+# Slack puts the type first in most frames, so it can be read without
+# decoding the rest.
+_FRAME_TYPE = re.compile(r'\{\s*"type"\s*:\s*"([^"\\]*)"')
 
 
 class SlackError(Exception):
@@ -17,51 +58,717 @@ class SlackAPI(object):
     def __init__(self, bot):
         self._bot = bot
         self._listeners = []
+        self._ws = None
+        self.api_url = getattr(config, 'api_url', SlackAPI.API_URL)
 
-    def start_listening(self, listener):
-        self._listeners.append(listener)
+        # Keep connections to the Web API alive between calls, rather
+        # than paying for a new TLS handshake every time.
+        self._session = requests.Session()
+        pool_size = getattr(config, 'web_pool_size', 4)
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self._session.mount('https://', adapter)
+        self._session.mount('http://', adapter)
+        self._timeout = getattr(config, 'web_timeout', (5, 30))  # (connect, read) seconds
+        self.web_latency = collections.defaultdict(util.Histogram)  # per method
+        self.scheduler = WebScheduler(self)
+
+        # The supervisor owns the websocket once it's up: it pings Slack
+        # to check the connection's alive, and reconnects when it's not.
+        # Sends wait for `_connected` while it does.
+        self._connected = threading.Event()
+        self._lost = threading.Event()
+        self._closing = threading.Event()
+        self._ping_interval = getattr(config, 'ping_interval', 30)  # seconds
+        self._ping_ids = itertools.count(1)
+        self._ping_sent = None  # (id, time) of the ping awaiting a pong
+        self._backoff = getattr(config, 'reconnect_backoff', 1)  # seconds
+        self._backoff_max = getattr(config, 'reconnect_backoff_max', 120)
+        self._attempts = 0  # reconnects since a connection last proved healthy
+        self.ping_rtt = util.Histogram()
+        self.dropped = collections.Counter()  # event type: frames nobody wanted
+        self.reconnects = 0
+        self.downtime = 0.
+        # Optionally keep every frame received, e.g. to benchmark codecs on.
+        record_frames = getattr(config, 'record_frames', None)
+        self._frame_log = open(record_frames, 'a') if record_frames else None
+
+        supervisor = threading.Thread(target=self._supervise)
+        supervisor.setDaemon(True)
+        supervisor.start()
+
+    def start_listening(self, listener, wants=None):
+        """
+        Have `listener` called with every event received. If `wants` is
+        given, it's called with each event's type first, and events it
+        returns False for are skipped (and, if no listener wants them,
+        not even decoded).
+        """
+        self._listeners.append((listener, wants))
+
+    def stop_listening(self, listener):
+        self._listeners = [entry for entry in self._listeners if entry[0] != listener]
 
     def connect(self):
-        self._request_data = self.send_web('rtm.start', {})
-        if not self._request_data['ok']:
-            raise SlackError(self._request_data['error'])
-
-        _ims = self._request_data[u'ims']
-        self._bot.users = {v[u'id']: v for v in self._request_data.pop(u'users')}
-        for user_id, user in self._bot.users.iteritems():
-            user[u'im'] = next((im[u'id'] for im in _ims if im[u'user'] == user_id), None)
-        self._bot._channels = self._request_data.pop(u'channels')
-        _self = self._request_data.pop(u'self')
-        self._bot.user_name = _self[u'name']
-        self._bot.user = _self[u'id']
+        started = time.time()
+        response = self._post('rtm.start', {}, stream=True)
+        response.raise_for_status()
+        self._request_data = {}
+        if ijson is None:
+            entries = _read_rtm_start(response, self._request_data)
+        else:
+            entries = _stream_rtm_start(response, self._request_data)
+
+        # Don't touch the directory unless there's something to fill it with.
+        first_entry = next(entries, None)
+        changes = {}
+        if first_entry is not None:
+            changes = self._bot.directory.load(itertools.chain([first_entry], entries))
+        if not self._request_data.get('ok'):
+            raise SlackError(self._request_data.get('error'))
+
+        _self = self._request_data.pop('self')
+        self._bot.set_identity(_self[u'id'], _self[u'name'])
 
         self._connect_websocket(self._request_data['url'])
+        self._bot.debug(
+            "Connected in {:.2f}s ({} added, {} changed, {} removed). "
+            "Peak memory use is {:.1f}MB.".format(
+                time.time() - started,
+                changes.get('added', 0), changes.get('changed', 0), changes.get('removed', 0),
+                peak_rss() / 1024. / 1024),
+            'gray')
 
     def _connect_websocket(self, url):
+        old_ws = self._ws
+        self._connected.clear()
         self._ws = websocket.WebSocketApp(
             url,
+            on_open=self._on_ws_open,
             on_message=self._on_receive,
             on_error=self._on_ws_error,
         )
+        self._ping_sent = None
+        self._lost.clear()
+        if old_ws is not None:
+            old_ws.close()
 
-        t = threading.Thread(target=self._ws.run_forever)
+        t = threading.Thread(target=self._run_websocket, args=(self._ws,))
         t.setDaemon(True)
         t.start()
 
+    def _run_websocket(self, ws):
+        ws.run_forever()
+        self._disconnected(ws)
+
+    def _disconnected(self, ws):
+        """Note `ws` has failed, reconnecting unless it's been replaced or closed on purpose."""
+        if ws is self._ws:
+            self._connected.clear()
+            self.reconnect()
+
+    def reconnect(self):
+        """Have the supervisor replace the connection with a new one."""
+        self._lost.set()
+
+    def close(self):
+        self._closing.set()
+        self._lost.set()
+        self._connected.set()  # Wake any sends waiting, to give up.
+        ws, self._ws = self._ws, None
+        if ws is not None:
+            ws.close()
+        self._session.close()
+        if self._frame_log is not None:
+            self._frame_log.close()
+
+    def stats(self):
+        """Get lines describing the connection's metrics."""
+        return [
+            "websocket: {} reconnects, {:.1f}s down".format(self.reconnects, self.downtime),
+            "ping: {}".format(self.ping_rtt),
+            "ignored: {} events ({})".format(sum(self.dropped.itervalues()), ", ".join(
+                "{} {}".format(count, event_type)
+                for event_type, count in self.dropped.most_common(5))),
+        ] + [
+            "web {}: {}".format(method, latency)
+            for method, latency in sorted(self.web_latency.iteritems())
+        ] + self.scheduler.stats()
+
+    def _supervise(self):
+        while not self._closing.is_set():
+            self._lost.wait(self._ping_interval)
+            if self._closing.is_set():
+                return
+            try:
+                if not self._lost.is_set() and self._ws is not None:
+                    self._check_alive()
+                if self._lost.is_set():
+                    self._reestablish()
+            except Exception:
+                self._bot.debug(traceback.format_exc(), 'red')
+                self._closing.wait(self._backoff)  # Don't spin on a persistent error.
+
+    def _check_alive(self):
+        """Ping Slack, noting the connection lost if the last ping got no pong."""
+        if self._ping_sent is not None:
+            self._bot.debug("No pong in {}s, reconnecting.".format(self._ping_interval), 'yellow')
+            self.reconnect()
+            return
+        ping_id = next(self._ping_ids)
+        self._ping_sent = (ping_id, time.time())
+        try:
+            self.send({'id': ping_id, 'type': 'ping'}, wait=False)
+        except Exception:
+            self.reconnect()
+
+    def _reestablish(self):
+        """
+        Reconnect, backing off with jitter before every attempt. The
+        backoff keeps growing across reconnects until a connection
+        proves healthy by answering a ping, so a socket that dies as
+        soon as it's made doesn't have rtm.start called in a loop.
+        """
+        lost_at = time.time()
+        self._connected.clear()
+        ws, self._ws = self._ws, None
+        if ws is not None:
+            ws.close()
+        self._bot.disconnected()
+        delay = self._next_delay()
+        while not self._closing.wait(delay):
+            try:
+                self.connect()
+            except Exception as e:
+                delay = self._next_delay()
+                self._bot.debug("Reconnect failed ({}), retrying in {:.1f}s.".format(e, delay), 'yellow')
+                continue
+            if not self._wait_open():
+                delay = self._next_delay()
+                self._bot.debug("New connection didn't open, retrying in {:.1f}s.".format(delay), 'yellow')
+                continue
+            down = time.time() - lost_at
+            self.reconnects += 1
+            self.downtime += down
+            self._bot.reconnected(down)
+            return
+
+    def _next_delay(self):
+        """Get how long to wait before the next reconnect, and count it."""
+        delay = random.uniform(0, min(self._backoff_max, self._backoff * 2 ** min(self._attempts, 30)))
+        self._attempts += 1
+        return delay
+
+    def _wait_open(self):
+        """
+        Wait up to a ping interval for the websocket just made to open.
+        Returns whether it did, rather than being lost (or the API
+        closed) first.
+        """
+        deadline = time.time() + self._ping_interval
+        while not self._closing.is_set() and not self._lost.is_set() and time.time() < deadline:
+            if self._connected.wait(0.1):
+                return not self._closing.is_set()
+        return False
+
+    def _on_ws_open(self, ws):
+        if ws is self._ws:
+            self._connected.set()
+
     def _on_ws_error(self, ws, error):
-        print error
-        print "Reconnecting..."
-        self.connect()
+        if ws is self._ws:
+            self._bot.debug("Websocket error: {!r}".format(error), 'yellow')
 
     def _on_receive(self, ws, message):
-        response = json.loads(message)
-        for listener in self._listeners:
-            listener(response)
+        if self._frame_log is not None:
+            self._frame_log.write(message.encode('utf-8') if isinstance(message, unicode) else message)
+            self._frame_log.write('\n')
+        peeked = _FRAME_TYPE.match(message)
+        if peeked is not None:
+            event_type = peeked.group(1)
+            if event_type != u'pong' and not self._wanted(event_type):
+                self.dropped[event_type] += 1
+                return
+        response = codec.loads(message)
+        event_type = response.get(u'type')
+        if event_type == u'pong':
+            ping_sent = self._ping_sent
+            if ping_sent is not None and response.get(u'reply_to') == ping_sent[0]:
+                self.ping_rtt.record(time.time() - ping_sent[1])
+                self._ping_sent = None
+                self._attempts = 0  # The connection's healthy.
+            return
+        wanted = False
+        for listener, wants in self._listeners:
+            if wants is None or wants(event_type):
+                wanted = True
+                listener(response)
+        if not wanted:
+            self.dropped[event_type] += 1
+
+    def _wanted(self, event_type):
+        return any(wants is None or wants(event_type) for _, wants in self._listeners)
+
+    def wait_connected(self, timeout=None):
+        """
+        Wait until the websocket's up. Returns whether it is, which it
+        won't be if `timeout` seconds pass first or it's been closed.
+        """
+        return self._connected.wait(timeout) and not self._closing.is_set()
 
-    def send(self, payload):
-        self._ws.send(json.dumps(payload))
+    def send(self, payload, wait=True):
+        """
+        Send an event over the websocket. While it's down, wait for the
+        supervisor to bring it back up, so nothing sent mid-reconnect
+        is lost. Raises SlackError if the websocket's been closed, or
+        is down and not `wait`.
+        """
+        frame = codec.dumps(payload)
+        while 1:
+            if wait and not self.wait_connected():
+                raise SlackError("Connection closed.")
+            ws = self._ws
+            if ws is not None and self._connected.is_set():
+                try:
+                    ws.send(frame)
+                    return
+                except (websocket.WebSocketException, IOError):
+                    self._disconnected(ws)
+            if not wait:
+                raise SlackError("Not connected.")
 
     def send_web(self, message_type, payload):
+        return codec.loads(self._post(message_type, payload).content)
+
+    def send_web_async(self, message_type, payload, key=None):
+        """
+        Queue a Web API call to be made in the background, within
+        Slack's rate limits. Returns a `WebCall` to optionally wait on.
+
+        Calls that share a `key` and haven't been made yet are merged,
+        the latest payload winning.
+        """
+        return self.scheduler.submit(message_type, payload, key)
+
+    def _post(self, message_type, payload, **kwargs):
         payload = dict(payload)
         payload.update({'token': config.token})
-        return requests.post(SlackAPI.API_URL + message_type, data=payload, verify=False).json()
+        started = time.time()
+        response = self._session.post(
+            self.api_url + message_type, data=payload, verify=False,
+            timeout=self._timeout, **kwargs)
+        self.web_latency[message_type].record(time.time() - started)
+        return response
+
+
+class Outbox(object):
+    """
+    Sends messages on a background thread, paced per channel to stay
+    clear of Slack's flood limits (about one message per second).
+
+    Messages queued for the same channel within `window` seconds of
+    each other are coalesced into one message, up to `max_length`
+    characters, before being handed to `send(channel, text,
+    formatted_text, attempt)`. `attempt` counts how many times the
+    message's been sent before (the most of any coalesced into it).
+
+    If `send` raises, the message is dropped, and `on_error(channel,
+    text)` is called from inside the handler so it can report why.
+    """
+    def __init__(self, send, rate=1., burst=3, window=0.1, max_length=util.MAX_MESSAGE_LENGTH,
+                 on_error=None):
+        self._send = send
+        self._on_error = on_error
+        self.rate = rate
+        self.burst = burst
+        self.window = window
+        self.max_length = max_length
+        self._condition = threading.Condition()
+        self._queues = collections.defaultdict(collections.deque)  # channel: messages
+        self._buckets = {}  # channel: util.TokenBucket
+        self._in_flight = 0
+        self.coalesced = 0
+
+        t = threading.Thread(target=self._run)
+        t.setDaemon(True)
+        t.start()
+
+    def put(self, channel, text, formatted_text, attempt=0):
+        with self._condition:
+            self._queues[channel].append((text, formatted_text, time.time(), attempt))
+            self._condition.notify()
+
+    def join(self, timeout=None):
+        """
+        Wait until every queued message has been sent. Returns whether
+        they all were before `timeout` seconds passed.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self._condition:
+            while self._in_flight or any(self._queues.itervalues()):
+                if deadline is None:
+                    self._condition.wait()
+                elif time.time() >= deadline:
+                    return False
+                else:
+                    self._condition.wait(deadline - time.time())
+        return True
+
+    def stats(self):
+        return ["outbox: {} waiting, {} coalesced".format(
+            sum(map(len, self._queues.itervalues())), self.coalesced)]
+
+    def _next_batch(self):
+        """
+        Wait until some channel may be sent to, then take as many of
+        its queued messages as fit in one.
+        """
+        with self._condition:
+            while 1:
+                now = time.time()
+                ready_at = None
+                for channel, queue in self._queues.iteritems():
+                    if not queue:
+                        continue
+                    bucket = self._buckets.get(channel)
+                    if bucket is None:
+                        bucket = self._buckets[channel] = util.TokenBucket(self.rate, self.burst)
+                    ready = max(queue[0][2] + self.window, now + bucket.wait_time(now))
+                    if ready <= now:
+                        bucket.take(now)
+                        self._in_flight += 1
+                        return channel, self._take(queue)
+                    ready_at = ready if ready_at is None else min(ready_at, ready)
+                self._condition.wait(None if ready_at is None else ready_at - now)
+
+    def _take(self, queue):
+        texts = []
+        formatted_texts = []
+        length = -1
+        attempt = 0
+        while queue and (not texts or length + 1 + len(queue[0][0]) <= self.max_length):
+            text, formatted_text, _, message_attempt = queue.popleft()
+            texts.append(text)
+            formatted_texts.append(formatted_text)
+            length += 1 + len(text)
+            attempt = max(attempt, message_attempt)
+        self.coalesced += len(texts) - 1
+        return texts, formatted_texts, attempt
+
+    def _run(self):
+        while 1:
+            channel, (texts, formatted_texts, attempt) = self._next_batch()
+            text = u'\n'.join(texts)
+            try:
+                self._send(channel, text, u'\n'.join(formatted_texts), attempt)
+            except Exception:
+                try:
+                    if self._on_error is None:
+                        raise
+                    self._on_error(channel, text)
+                except Exception:
+                    traceback.print_exc()
+            finally:
+                with self._condition:
+                    self._in_flight -= 1
+                    self._condition.notify_all()
+
+
+class AckTracker(object):
+    """
+    Messages sent over the websocket that Slack hasn't acknowledged
+    yet, by message id. Pop a message's entry when its `reply_to`
+    comes in, as with a dict.
+
+    Entries still unacknowledged after `ttl` seconds are dropped by
+    `expire`, which hands each to `on_expire(message_id, entry,
+    attempt)` so it can be reported or sent again.
+    """
+    def __init__(self, ttl=30, on_expire=None):
+        self.ttl = ttl
+        self._on_expire = on_expire
+        self._pending = collections.OrderedDict()  # id: (entry, channel, sent time, attempt)
+        self._lock = threading.Lock()
+        self.latency = collections.defaultdict(util.Histogram)  # per channel
+        self.expired = 0
+
+    def __len__(self):
+        return len(self._pending)
+
+    def __contains__(self, message_id):
+        return message_id in self._pending
+
+    def add(self, message_id, entry, attempt=0):
+        with self._lock:
+            self._pending[message_id] = (entry, entry.get(u'channel'), time.time(), attempt)
+
+    def pop(self, message_id, *default):
+        with self._lock:
+            if message_id not in self._pending:
+                if default:
+                    return default[0]
+                raise KeyError(message_id)
+            entry, channel, sent, _ = self._pending.pop(message_id)
+        self.latency[channel].record(time.time() - sent)
+        return entry
+
+    def expire(self, everything=False):
+        """
+        Drop the entries older than the ttl, or all of them if
+        `everything` (say, because the connection they were sent on is
+        gone).
+        """
+        cutoff = time.time() - self.ttl
+        expired = []
+        with self._lock:
+            # Entries are kept in the order they were sent.
+            while self._pending:
+                message_id, pending = next(self._pending.iteritems())
+                if not everything and pending[2] > cutoff:
+                    break
+                del self._pending[message_id]
+                expired.append((message_id, pending))
+        self.expired += len(expired)
+        if self._on_expire is not None:
+            for message_id, (entry, _, _, attempt) in expired:
+                try:
+                    self._on_expire(message_id, entry, attempt)
+                except Exception:  # Don't let one entry keep the rest from being handled.
+                    traceback.print_exc()
+        return len(expired)
+
+    def stats(self, channel_name=lambda channel: channel):
+        return ["acks: {} pending, {} expired".format(len(self), self.expired)] + [
+            "ack {}: {}".format(channel_name(channel), latency)
+            for channel, latency in sorted(self.latency.iteritems())
+        ]
+
+
+class WebCall(object):
+    """
+    A Web API call queued with a `WebScheduler`; a future for its
+    response.
+    """
+    def __init__(self, method, payload, key=None):
+        self.method = method
+        self.payload = dict(payload)
+        self.key = key
+        self.attempts = 0
+        self._done = threading.Event()
+        self._result = None
+        self._error = None
+        self._followers = []  # superseded calls that share this call's result
+
+    def done(self):
+        return self._done.is_set()
+
+    def result(self, timeout=None):
+        """
+        Wait for the call to be made, and return the response. Raises
+        SlackError if the call failed, or `timeout` seconds pass first.
+        """
+        if not self._done.wait(timeout):
+            raise SlackError("Timed out waiting on {}.".format(self.method))
+        if self._error is not None:
+            raise self._error
+        return self._result
+
+    def _resolve(self, result=None, error=None):
+        self._result = result
+        self._error = error
+        self._done.set()
+        for follower in self._followers:
+            follower._resolve(result, error)
+
+
+class WebScheduler(object):
+    """
+    Makes Web API calls in the background, pacing each method to stay
+    within Slack's rate limit tier for it. Each method gets a thread of
+    its own, so a slow or rate limited method doesn't hold up the rest.
+
+    Calls rejected for rate limiting are retried after the Retry-After
+    Slack asks for. Calls that fail to connect are retried with
+    exponential backoff, up to `retries` times.
+    """
+    def __init__(self, api, retries=3):
+        self._api = api
+        self.retries = retries
+        self._condition = threading.Condition()
+        self._queues = collections.defaultdict(collections.deque)  # method: calls
+        self._next_allowed = collections.defaultdict(float)  # method: time
+        self._pending = {}  # key: queued call
+        self._threads = {}  # method: thread making its calls
+        self._in_flight = 0
+        self.merged = 0
+        self.rate_limited = 0
+        self.retried = 0
+
+    def submit(self, method, payload, key=None):
+        with self._condition:
+            if key is not None and key in self._pending:
+                call = self._pending[key]
+                call.payload = dict(payload)
+                self.merged += 1
+                return call
+            call = WebCall(method, payload, key)
+            self._enqueue(call)
+            return call
+
+    def join(self, timeout=None):
+        """
+        Wait until every queued call has been made. Returns whether they
+        all were before `timeout` seconds passed.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self._condition:
+            while self._in_flight or any(self._queues.itervalues()):
+                if deadline is None:
+                    self._condition.wait()
+                elif time.time() >= deadline:
+                    return False
+                else:
+                    self._condition.wait(deadline - time.time())
+        return True
+
+    def stats(self):
+        return ["web queue: {} waiting, {} merged, {} rate limited, {} retried".format(
+            sum(map(len, self._queues.itervalues())),
+            self.merged, self.rate_limited, self.retried)]
+
+    @staticmethod
+    def _interval(method):
+        return 60. / _TIER_LIMITS[_METHOD_TIERS.get(method, _DEFAULT_TIER)]
+
+    def _enqueue(self, call, delay=0, front=False):
+        """Queue a call, optionally holding off its method `delay` seconds."""
+        with self._condition:
+            if call.key is not None:
+                newer = self._pending.get(call.key)
+                if newer is not None:
+                    # A newer call will carry this one's payload's successor.
+                    newer._followers.append(call)
+                    return
+                self._pending[call.key] = call
+            queue = self._queues[call.method]
+            if front:
+                queue.appendleft(call)
+            else:
+                queue.append(call)
+            if delay:
+                self._next_allowed[call.method] = max(
+                    self._next_allowed[call.method], time.time() + delay)
+            if call.method not in self._threads:
+                t = threading.Thread(target=self._run, args=(call.method,))
+                t.setDaemon(True)
+                t.start()
+                self._threads[call.method] = t
+            self._condition.notify_all()
+
+    def _next_call(self, method):
+        """Wait for, and take, the next call of `method` that may be made."""
+        queue = self._queues[method]
+        with self._condition:
+            while 1:
+                now = time.time()
+                allowed = self._next_allowed[method]
+                if queue and allowed <= now:
+                    call = queue.popleft()
+                    if call.key is not None:
+                        del self._pending[call.key]
+                    self._next_allowed[method] = now + self._interval(method)
+                    self._in_flight += 1
+                    return call
+                self._condition.wait(allowed - now if queue else None)
+
+    def _run(self, method):
+        while 1:
+            call = self._next_call(method)
+            try:
+                self._make(call)
+            except Exception as e:
+                call._resolve(error=SlackError(e))
+            finally:
+                with self._condition:
+                    self._in_flight -= 1
+                    self._condition.notify_all()
+
+    def _make(self, call):
+        call.attempts += 1
+        try:
+            response = self._api._post(call.method, call.payload)
+        except requests.RequestException as e:
+            if call.attempts > self.retries:
+                call._resolve(error=SlackError(e))
+                return
+            self.retried += 1
+            self._enqueue(call, delay=2 ** call.attempts, front=True)
+            return
+
+        if response.status_code == 429:
+            self.rate_limited += 1
+            retry_after = float(response.headers.get('Retry-After', 1))
+            call.attempts -= 1  # Slack's pacing, not our failure
+            self._enqueue(call, delay=retry_after, front=True)
+            return
+        try:
+            call._resolve(codec.loads(response.content))
+        except ValueError as e:
+            call._resolve(error=SlackError(e))
+
+
+def _read_rtm_start(response, fields):
+    """
+    Read an rtm.start response all at once, yielding its users,
+    channels, and ims as ('user' | 'channel' | 'im', object) pairs.
+    The other top level fields the bot needs are put in `fields`.
+    """
+    data = codec.loads(response.content)
+    for field in _RTM_START_FIELDS:
+        fields[field] = data.get(field)
+    for prefix, kind in _RTM_START_ENTRIES.iteritems():
+        for entry in data.pop(prefix.split('.')[0], None) or ():
+            yield kind, entry
+
+
+def _stream_rtm_start(response, fields):
+    """
+    Parse an rtm.start response incrementally as it downloads, yielding
+    its users, channels, and ims as ('user' | 'channel' | 'im', object)
+    pairs as soon as each is read. The other top level fields the bot
+    needs are put in `fields`.
+
+    Only one entry is held in memory at a time, rather than the whole
+    (multi-megabyte, on large teams) document.
+    """
+    response.raw.decode_content = True  # undo any gzip
+    building = None  # (prefix, kind) of the object being built
+    for prefix, event, value in ijson.parse(response.raw):
+        if building is not None:
+            builder.event(event, value)
+            if prefix == building[0] and event in ('end_map', 'end_array'):
+                if building[1] in _RTM_START_FIELDS:
+                    fields[building[1]] = builder.value
+                else:
+                    yield building[1], builder.value
+                building = None
+            continue
+
+        kind = _RTM_START_ENTRIES.get(prefix)
+        if kind is None and prefix in _RTM_START_FIELDS:
+            kind = prefix
+        if kind is None:
+            continue
+        if event in ('start_map', 'start_array'):
+            building = (prefix, kind)
+            builder = ijson.common.ObjectBuilder()
+            builder.event(event, value)
+        elif event not in ('map_key', 'end_map', 'end_array') and kind in _RTM_START_FIELDS:
+            fields[kind] = value
+
+
+def peak_rss():
+    """Get the peak resident memory use of the process, in bytes."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return peak
+    return peak * 1024
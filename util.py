@@ -1,11 +1,14 @@
 from __future__ import absolute_import, print_function
 
+import bisect
 import collections
 import contextlib
 import HTMLParser
 import random
 import re
 import sys
+import threading
+import time
 
 html = HTMLParser.HTMLParser()
 
@@ -87,58 +90,152 @@ def hilite_string(color, string, skip_stack=False):
         return string
 
 
-def format_incoming_text(bot, text, user_fn=r'\g<0>', channel_fn=r'\g<0>',
-                         notice_fn=r'\g<0>', url_fn=r'\g<0>'):
+# Slack's markup, per https://api.slack.com/docs/formatting
+USER, CHANNEL, NOTICE, URL, ENTITY, TEXT = 'user', 'channel', 'notice', 'url', 'entity', 'text'
+_MARKUP = re.compile(
+    r'<@(?P<user>\w+)(?:\|[^>]+)?>'
+    r'|<#(?P<channel>\w+)(?:\|[^>]+)?>'
+    r'|<!(?P<notice>\w+)>'
+    r'|<(?P<url>[^@#!][^>]*)>'
+    r'|(?P<entity>&(?:\w+|#\d+|#x[0-9a-fA-F]+);)'
+)
+
+# The only entities Slack escapes text with.
+_ENTITIES = {u'&amp;': u'&', u'&lt;': u'<', u'&gt;': u'>'}
+
+# A piece of Slack-formatted text: a run of plain text, or one bit of
+# markup. `value` is what's inside the markup (an id, a url...), and
+# `source` the text as it came, from `start` to `end`.
+Token = collections.namedtuple('Token', 'kind value source start end')
+_new_token = tuple.__new__  # skips Token.__new__'s argument handling, for speed
+
+
+def tokenize(text):
+    """Split Slack-formatted text into Tokens, in order."""
+    tokens = []
+    append = tokens.append
+    position = 0
+    for match in _MARKUP.finditer(text):
+        start, end = match.span()
+        if start > position:
+            plain = text[position:start]
+            append(_new_token(Token, (TEXT, plain, plain, position, start)))
+        kind = match.lastgroup
+        append(_new_token(Token, (kind, match.group(kind), match.group(0), start, end)))
+        position = end
+    if position < len(text):
+        plain = text[position:]
+        append(_new_token(Token, (TEXT, plain, plain, position, len(text))))
+    return tokens
+
+
+def render_tokens(bot, tokens, renderers):
     """
-    https://api.slack.com/docs/formatting
+    Join tokens back into text, rendering each with the function for
+    its kind in `renderers`, which is passed the bot and the token.
+    Markup without a renderer is left as it came. Everything but plain
+    text is unescaped, renderings included, so the text reads as if
+    it had been unescaped as a whole.
     """
-    # Wrap functions to allow passing bot and match, while still allowing plain strings.
-    _user_fn, _channel_fn, _notice_fn, _url_fn = (
-        fn if isinstance(fn, basestring) else lambda match, fn_=fn: fn_(bot, match)
-        for fn in (user_fn, channel_fn, notice_fn, url_fn)
-    )
-    text = re.sub(r'<@(\w+)(?:\|[^>]+)?>', _user_fn, text)
-    text = re.sub(r'<#(\w+)(?:\|[^>]+)?>', _channel_fn, text)
-    text = re.sub(r'<!(\w+)>', _notice_fn, text)
-    text = re.sub(r'<([^@#!][^>]*)>', _url_fn, text)
-    # Make sure this step is last.
-    return unescape(text)
+    pieces = []
+    append = pieces.append
+    for token in tokens:
+        kind = token[0]
+        if kind == TEXT:
+            append(token[2])
+        elif kind in renderers:
+            rendered = renderers[kind](bot, token)
+            append(unescape(rendered) if u'&' in rendered else rendered)
+        elif kind == ENTITY:
+            entity = token[2]
+            append(_ENTITIES.get(entity) or unescape(entity))
+        else:
+            source = token[2]
+            append(unescape(source) if u'&' in source else source)
+    return u''.join(pieces)
 
 
-def _flatten_user(bot, match):
-    user_id = match.group(1)
-    user = bot.get_nick(user_id)
+def render_span(bot, tokens, start, end, renderers):
+    """
+    Render the part of tokenized text from offset `start` to `end` as
+    `render_tokens` would render that part on its own. Returns None if
+    the span cuts through markup, which would tokenize differently.
+    """
+    pieces = []
+    for token in tokens:
+        if token.end <= start:
+            continue
+        if token.start >= end:
+            break
+        if token.start >= start and token.end <= end:
+            pieces.append(token)
+        elif token.kind == TEXT:
+            cut = token.source[max(start, token.start) - token.start:min(end, token.end) - token.start]
+            pieces.append(_new_token(Token, (TEXT, cut, cut, max(start, token.start), min(end, token.end))))
+        else:
+            return None
+    return render_tokens(bot, pieces, renderers)
+
+
+def format_incoming_text(bot, text, user_fn=None, channel_fn=None, notice_fn=None, url_fn=None):
+    """
+    Render Slack-formatted text with the given functions for each kind
+    of markup, each passed the bot and a Token.
+    """
+    renderers = {
+        kind: fn for kind, fn in [
+            (USER, user_fn), (CHANNEL, channel_fn), (NOTICE, notice_fn), (URL, url_fn),
+        ] if fn is not None
+    }
+    return render_tokens(bot, tokenize(text), renderers)
+
+
+def _flatten_user(bot, token):
+    user = bot.get_nick(token.value)
     if user:
-        return "@" + user
-    return match.group(0)
+        return u"@" + user
+    return token.source
 
 
-def _flatten_channel(bot, match):
-    channel_id = match.group(1)
-    channel = bot.get_channel_name(channel_id)
+def _flatten_channel(bot, token):
+    channel = bot.get_channel_name(token.value)
     if channel:
         return channel
-    return match.group(0)
+    return token.source
+
+
+def _flatten_notice(bot, token):
+    return u"@" + token.value
+
+
+def _flatten_url(bot, token):
+    return token.value
+
+
+def flatten_renderers(flatten_user=True, flatten_channel=True,
+                      flatten_notice=True, flatten_url=True):
+    """Get the renderers `flatten_incoming_text` uses, for `render_tokens`."""
+    return {
+        kind: fn
+        for kind, fn, active in [
+            (USER, _flatten_user, flatten_user),
+            (CHANNEL, _flatten_channel, flatten_channel),
+            (NOTICE, _flatten_notice, flatten_notice),
+            (URL, _flatten_url, flatten_url),
+        ] if active
+    }
 
 
-def flatten_incoming_text(bot, text, flatten_user=True, flatten_channel=True,
-                          flatten_notice=True, flatten_url=True):
+def flatten_incoming_text(bot, text, **kwargs):
     """
     Format incoming text as a client might see it, with no formatting.
 
     Notably, unescapes user tags and notices into @mentions, channels
-    into #mentions, urls into flat urls, and html into plaintext.
-    """
-    kwargs = {
-        name: value
-        for name, value, active in [
-            ('user_fn', _flatten_user, flatten_user),
-            ('channel_fn', _flatten_channel, flatten_channel),
-            ('notice_fn', r"@\1", flatten_notice),
-            ('url_fn', r"\1", flatten_url),
-        ] if active
-    }
-    return format_incoming_text(bot, text, **kwargs)
+    into #mentions, urls into flat urls, and html into plaintext. Pass
+    flatten_user, flatten_channel, flatten_notice, or flatten_url as
+    False to leave that kind of markup be.
+    """
+    return render_tokens(bot, tokenize(text), flatten_renderers(**kwargs))
 
 
 def unescape(text):
@@ -154,6 +251,39 @@ def valid_regex(regex):
         return True
 
 
+_CODE_FENCE = u'```'
+
+
+def split_message(text, max_length=MAX_MESSAGE_LENGTH):
+    """
+    Split text into chunks of at most max_length characters, breaking
+    between lines where possible. A ``` block that spans a break is
+    closed at the end of one chunk and reopened at the start of the
+    next, so each chunk renders on its own.
+    """
+    if len(text) <= max_length:
+        yield text
+        return
+    fence = _CODE_FENCE
+    budget = max_length - len(fence)  # leave room to close a block
+    line_length = budget - len(fence) - 1  # ...and to reopen it
+    lines = []
+    length = 0
+    in_code = False
+    for whole_line in text.split(u'\n'):
+        for start in xrange(0, max(len(whole_line), 1), line_length):
+            line = whole_line[start:start + line_length]
+            if lines and length + 1 + len(line) > budget:
+                yield u'\n'.join(lines) + (fence if in_code else u'')
+                lines = [fence] if in_code else []
+                length = len(fence) if in_code else -1
+            lines.append(line)
+            length += 1 + len(line)
+            if line.count(fence) % 2:
+                in_code = not in_code
+    yield u'\n'.join(lines)
+
+
 class RandomizedLeastRecentlyUsed(object):
     """
     Container data structure to aggregate elements and return a random
@@ -177,3 +307,83 @@ class RandomizedLeastRecentlyUsed(object):
             elem = self._rlru.popleft()
             self._rlru.append(elem)
         return elem
+
+
+class Histogram(object):
+    """
+    Summary of a series of measurements (usually durations, in
+    seconds): their count, mean, and max, plus counts per bucket to
+    estimate percentiles with.
+    """
+    BOUNDS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self, bounds=BOUNDS):
+        self.bounds = tuple(bounds)
+        self.buckets = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.total = 0.
+        self.max = 0.
+        self._lock = threading.Lock()
+
+    def record(self, value):
+        with self._lock:
+            self.buckets[bisect.bisect_left(self.bounds, value)] += 1
+            self.count += 1
+            self.total += value
+            self.max = max(self.max, value)
+
+    @property
+    def mean(self):
+        if not self.count:
+            return 0.
+        return self.total / self.count
+
+    def percentile(self, fraction):
+        """
+        Estimate the value below which `fraction` of the measurements
+        fall, as the upper bound of the bucket it lands in.
+        """
+        target = fraction * self.count
+        seen = 0
+        for bound, count in zip(self.bounds, self.buckets):
+            seen += count
+            if seen >= target:
+                return min(bound, self.max)
+        return self.max
+
+    def __str__(self):
+        if not self.count:
+            return "no data"
+        return "n={} mean={:.0f}ms p50={:.0f}ms p99={:.0f}ms max={:.0f}ms".format(
+            self.count, self.mean * 1000, self.percentile(.5) * 1000,
+            self.percentile(.99) * 1000, self.max * 1000)
+
+
+class TokenBucket(object):
+    """
+    Rate limiter allowing `rate` actions per second on average, in
+    bursts of up to `burst` at once.
+    """
+    def __init__(self, rate, burst=1):
+        self.rate = float(rate)
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time.time()
+
+    def _refill(self, now):
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def wait_time(self, now=None):
+        """Get how many seconds until an action is allowed."""
+        now = time.time() if now is None else now
+        self._refill(now)
+        if self._tokens >= 1:
+            return 0
+        return (1 - self._tokens) / self.rate
+
+    def take(self, now=None):
+        """Spend the allowance for one action."""
+        now = time.time() if now is None else now
+        self._refill(now)
+        self._tokens -= 1